@@ -0,0 +1,96 @@
+#!/usr/bin/python3
+
+import datetime
+
+# What each person's days, weeks, months and streaks look like, for
+# !history, !trend and !streak. The numbers come out of the daily and
+# monthly tables, which the EventLog keeps up to date, so nothing here has
+# to go through the events.
+
+def week_of(day):
+    # The ordinal of the Monday starting the week day is in. Ordinal 1 was a Monday.
+    return day - (day - 1) % 7
+
+def month_of(day):
+    # The ordinal of the first of the month day is in
+    return day - datetime.date.fromordinal(day).day + 1
+
+class Analytics(object):
+    '''
+    Per-person rollups by day, week and month. Whatever a command rendered for
+    somebody is kept until their next event (or until the day changes),
+    so asking again is a dict lookup. events is the EventLog, flushed
+    before anything is read so the daily table is up to date. '''
+
+    def __init__(self, c, events):
+        self.c = c
+        self.events = events
+        self.rendered = {}
+        self.day = None
+
+    def forget(self, userId):
+        self.rendered.pop(userId, None)
+
+    def cached(self, userId, key, render):
+        # What render() gives back for this user and key, only calling it if it isn't kept already
+        today = datetime.date.today().toordinal()
+        if today != self.day:
+            self.day = today
+            self.rendered = {}
+        texts = self.rendered.setdefault(userId, {})
+        if key not in texts:
+            texts[key] = render()
+        return texts[key]
+
+    def days(self, userId, first, last):
+        # (day, late, worked, clock-ins) for every day from first to last they did anything
+        self.events.flush()
+        return self.c.execute('''SELECT day, timeLate, timeSpent, clockIns FROM daily
+                                 WHERE user=? AND day >= ? AND day <= ? ORDER BY day''', (userId, first, last)).fetchall()
+
+    def weeks(self, userId, first, last):
+        # (Monday, late, worked, clock-ins) for every week from the ones with first and last in them
+        self.events.flush()
+        return self.c.execute('''SELECT day - (day - 1) % 7 AS week, TOTAL(timeLate), TOTAL(timeSpent), TOTAL(clockIns) FROM daily
+                                 WHERE user=? AND day >= ? AND day <= ? GROUP BY week ORDER BY week''',
+                              (userId, week_of(first), last)).fetchall()
+
+    def months(self, userId, first, last):
+        # (first of the month, late, worked, clock-ins) for every month from the ones with first and last in them
+        self.events.flush()
+        return self.c.execute('''SELECT month, timeLate, timeSpent, clockIns FROM monthly
+                                 WHERE user=? AND month >= ? AND month <= ? ORDER BY month''',
+                              (userId, month_of(first), last)).fetchall()
+
+    def streak(self, userId, today, workday):
+        '''
+        How many workdays in a row they've come in on time, up to today,
+        and the longest they've ever gone. workday(ordinal) says whether a
+        day counts. Not having come in yet today doesn't break it. Where
+        the streak stood at the end of yesterday is saved in the streaks
+        table, so next time only the days after that get read. '''
+
+        self.events.flush()
+        saved = self.c.execute('SELECT through, run, longest FROM streaks WHERE user=?', (userId,)).fetchone()
+        through, run, longest = saved or (0, 0, 0)
+        rows = self.c.execute('''SELECT day, timeLate, clockIns FROM daily WHERE user=? AND day > ? AND day <= ? ORDER BY day''',
+                              (userId, through, today)).fetchall()
+        if not saved:
+            if not rows:
+                return 0, 0
+            through = rows[0][0] - 1
+        onTime = set(day for day, late, clockIns in rows if clockIns and late <= 0)
+        for day in range(through + 1, today):
+            if workday(day):
+                run = run + 1 if day in onTime else 0
+                longest = max(longest, run)
+        if through < today - 1:
+            self.c.execute('INSERT OR REPLACE INTO streaks (user, through, run, longest) VALUES (?, ?, ?, ?)',
+                           (userId, today - 1, run, longest))
+        if workday(today):
+            if today in onTime:
+                run += 1
+                longest = max(longest, run)
+            elif rows and rows[-1][0] == today and rows[-1][2]:
+                run = 0
+        return run, longest
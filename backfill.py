@@ -0,0 +1,99 @@
+#!/usr/bin/python3
+
+import datetime
+
+import numpy as np
+
+from store import rebuild_rollups
+
+# Replays the whole events table against the current schedule and fixes
+# everybody's totals to match. Everything is done with array math over all
+# the events at once, so a year of events for the whole team takes seconds.
+
+def day_starts(schedule, userIds, first, last):
+    '''
+    The local midnight of every day from first to last (plus the one after
+    it), and a table of when each row is due in on each of those days. Row
+    0 is the normal schedule and row i + 1 is userIds[i]. nan means no
+    start time that day. '''
+
+    days = [first + datetime.timedelta(days=i) for i in range((last - first).days + 2)]
+    midnights = np.array([datetime.datetime.combine(day, datetime.time()).timestamp() for day in days])
+    starts = np.full((len(userIds) + 1, len(days)), np.nan)
+    for row, userId in enumerate([None] + list(userIds)):
+        for column, day in enumerate(days):
+            start = schedule.start(day, userId)
+            if start is not None:
+                starts[row, column] = start
+    return midnights, starts
+
+def backfill(c, schedule):
+    '''
+    Works out lateness for the first clock-in of every day and the time
+    worked between every clock-in and the clock-out after it. Then it
+    writes the events back, moves the users' totals by however much their
+    events changed, and redoes the rollup tables from them. Totals are only
+    ever moved, never summed from scratch, so time recorded before the
+    events table existed is kept. Everything goes through c, so it all
+    lands in the caller's transaction. Returns how many events there
+    were. '''
+
+    rows = c.execute('''SELECT id, user, kind, timestamp, seconds FROM events
+                        WHERE kind IN ('in', 'out') ORDER BY user, timestamp, id''').fetchall()
+    if not rows:
+        return 0
+    eventIds = np.array([row[0] for row in rows])
+    userIds, users = np.unique([row[1] for row in rows], return_inverse=True)
+    isIn = np.array([row[2] == 'in' for row in rows])
+    stamps = np.array([row[3] for row in rows])
+    recorded = np.array([row[4] for row in rows])
+
+    # Which day everything happened on, and when that person was due in that day
+    first = datetime.date.fromtimestamp(stamps.min())
+    last = datetime.date.fromtimestamp(stamps.max())
+    overridden = [userId for userId in userIds if userId in schedule.users]
+    midnights, starts = day_starts(schedule, overridden, first, last)
+    days = np.searchsorted(midnights, stamps, side='right') - 1
+    scheduleRows = np.zeros(len(userIds), dtype=int)
+    for row, userId in enumerate(overridden):
+        scheduleRows[np.searchsorted(userIds, userId)] = row + 1
+    due = starts[scheduleRows[users], days]
+
+    # Only the first clock-in of somebody's day can be late. Events are sorted by
+    # user and time, so that's any clock-in whose previous clock-in was somebody
+    # else's or on another day.
+    ins = np.flatnonzero(isIn)
+    firstOfDay = np.ones(len(ins), dtype=bool)
+    firstOfDay[1:] = (users[ins][1:] != users[ins][:-1]) | (days[ins][1:] != days[ins][:-1])
+    firstIn = np.zeros(len(rows), dtype=bool)
+    firstIn[ins[firstOfDay]] = True
+    late = np.where(firstIn & ~np.isnan(due), np.maximum(np.nan_to_num(stamps - due), 0), 0)
+
+    # Time worked is from a clock-in to the clock-out right after it. A clock-out
+    # without one in front of it keeps whatever it had.
+    sameUser = np.zeros(len(rows), dtype=bool)
+    sameUser[1:] = users[1:] == users[:-1]
+    worked = np.where(~isIn, recorded, 0.0)
+    paired = np.zeros(len(rows), dtype=bool)
+    paired[1:] = ~isIn[1:] & isIn[:-1] & sameUser[1:]
+    worked[1:] = np.where(paired[1:], stamps[1:] - stamps[:-1], worked[1:])
+
+    seconds = np.where(isIn, late, worked)
+    change = seconds - recorded
+
+    # The week started at the last reset
+    weekStart = c.execute('''SELECT IFNULL(MAX(timestamp), 0) FROM events WHERE kind='reset' ''').fetchone()[0]
+    thisWeek = stamps >= weekStart
+    count = len(userIds)
+    totalLate = np.bincount(users, weights=np.where(isIn, change, 0), minlength=count)
+    totalWorked = np.bincount(users, weights=np.where(isIn, 0, change), minlength=count)
+    weekLate = np.bincount(users, weights=np.where(isIn & thisWeek, change, 0), minlength=count)
+    weekWorked = np.bincount(users, weights=np.where(~isIn & thisWeek, change, 0), minlength=count)
+
+    changed = np.abs(change) > .001
+    c.executemany('UPDATE events SET seconds=? WHERE id=?', zip(seconds[changed].tolist(), eventIds[changed].tolist()))
+    c.executemany('''UPDATE users SET timeLateThisWeek=timeLateThisWeek + ?, totalTimeLate=totalTimeLate + ?,
+                                      timeSpentThisWeek=timeSpentThisWeek + ?, totalTimeSpent=totalTimeSpent + ? WHERE id=?''',
+                  zip(weekLate.tolist(), totalLate.tolist(), weekWorked.tolist(), totalWorked.tolist(), userIds.tolist()))
+    rebuild_rollups(c)
+    return len(rows)
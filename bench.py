@@ -0,0 +1,814 @@
+#!/usr/bin/python3
+
+import argparse
+import asyncio
+import collections
+import contextlib
+import datetime
+import io
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import requests
+
+import bot
+from fakeslack import FakeSlackClient, FakeWebAPI, make_users
+from schedule import DEFAULT_SCHEDULE, Schedule
+from slackapi import RATE_LIMITS, SlackWebClient, make_executor, make_session
+
+# Benchmarks that run the bot against a fake Slack team.
+# Run one with: python3 bench.py burst --users 500
+# or all of them with: python3 bench.py all
+# Each one checks its own results too, and the exit code says if any failed.
+
+# The fake Slack doesn't rate limit us, so we don't either
+NO_LIMITS = {'default': (1e9, 1e9)}
+
+def setup_team(userCount, dbName, wal=True):
+    # Builds a fresh database full of active users and points the bot at it
+    client = FakeSlackClient(users=make_users(userCount))
+    client.web_api = FakeWebAPI(client)
+    workspace = bot.use_slack(client, SlackWebClient(None, baseUrl=client.web_api.url, workers=bot.API_WORKERS, limits=NO_LIMITS), dbName)
+    with contextlib.redirect_stdout(io.StringIO()):
+        bot.initialize_db(dbName)
+    if not wal:
+        # The way the bot used to open it
+        workspace.connect = old_connect
+    bot.c.execute('''UPDATE users SET active=1''')
+    bot.conn.commit()
+    workspace.reload()
+    client.rtm_connect()
+    return client
+
+def old_connect(dbName):
+    conn = sqlite3.connect(dbName)
+    conn.execute('PRAGMA journal_mode=DELETE')
+    return conn
+
+def failing(connect, times):
+    # Opens a shard the way connect does, except the first few times, like a disk that's briefly gone
+    def flaky(dbName):
+        if flaky.failures:
+            flaky.failures -= 1
+            raise sqlite3.OperationalError("disk I/O error")
+        return connect(dbName)
+    flaky.failures = times
+    return flaky
+
+@contextlib.contextmanager
+def settings(**values):
+    # Changes some of bot's settings for one benchmark, and puts them back after
+    saved = dict((name, getattr(bot, name)) for name in values)
+    for name, value in values.items():
+        setattr(bot, name, value)
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            setattr(bot, name, value)
+
+def answer_times(client):
+    # When each DM channel first heard back from the bot
+    answered = {}
+    for method, kwargs, when in client.calls:
+        if method in ('reactions.add', 'chat.postMessage'):
+            answered.setdefault(kwargs['channel'], when)
+    return answered
+
+def run_bot(client, workload, finished=None):
+    '''
+    Runs the bot's event loop while workload sends messages from another
+    thread, until every message it sent has been answered (or finished
+    says it's done). Returns the events that were sent and when each one
+    went out. '''
+
+    finished = finished or (lambda sent: len(answer_times(client)) >= len(sent))
+
+    async def main():
+        loop = asyncio.get_event_loop()
+        server = asyncio.ensure_future(bot.serve())
+        sent = await loop.run_in_executor(None, workload)
+        while not finished(sent) and not server.done():
+            await asyncio.sleep(.01)
+        server.cancel()
+        return sent
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        sent = asyncio.run(main())
+        bot.wait_for_api_calls()
+    return sent
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def bench_burst(args):
+    '''
+    Everybody sends !in at the same moment. Every one of them should get
+    an answer, and we see how many commands per second we get through. '''
+
+    with tempfile.TemporaryDirectory() as tmp:
+        client = setup_team(args.users, os.path.join(tmp, 'team.db'))
+        client.calls.clear()
+
+        def workload():
+            return [(client.send('!in', user['id']), time.perf_counter()) for user in client.users]
+
+        sent = run_bot(client, workload)
+        wrong = bot.store.check_totals()
+        bot.team().close()
+
+    answered = answer_times(client)
+    lost = len(sent) - len(answered)
+    elapsed = max(answered.values()) - sent[0][1]
+
+    print("Sent " + str(len(sent)) + " commands, answered " + str(len(answered)) + ", lost " + str(lost))
+    print("%.1f commands per second" % (len(answered) / elapsed))
+    if wrong:
+        print("Running totals don't match the database: " + ", ".join(wrong))
+    return lost == 0 and not wrong
+
+def bench_latency(args):
+    '''
+    People send commands a few milliseconds apart, the way they trickle in
+    on a normal morning, and we see how long each one waits for an answer. '''
+
+    with tempfile.TemporaryDirectory() as tmp:
+        client = setup_team(args.users, os.path.join(tmp, 'team.db'))
+        client.calls.clear()
+
+        def workload():
+            sent = []
+            for user in client.users:
+                time.sleep(random.expovariate(1.0 / args.gap))
+                sent.append((client.send(args.command, user['id']), time.perf_counter()))
+            return sent
+
+        sent = run_bot(client, workload)
+        bot.team().close()
+
+    answered = answer_times(client)
+    latencies = [(answered[event['channel']] - when) * 1000 for event, when in sent if event['channel'] in answered]
+
+    print("Answered " + str(len(latencies)) + " of " + str(len(sent)) + " commands")
+    print("p50 %.2f ms, p99 %.2f ms" % (percentile(latencies, .5), percentile(latencies, .99)))
+    return len(latencies) == len(sent)
+
+def bench_addme(args):
+    '''
+    A whole new batch of people join Slack and send !addme. We should look
+    each one up on their own instead of downloading the team every time.
+    Then, with Slack's real rate limits, 30 more do while somebody already
+    on the team asks for !status, which shouldn't wait on their lookups. '''
+
+    with tempfile.TemporaryDirectory() as tmp:
+        client = setup_team(args.users, os.path.join(tmp, 'team.db'))
+        newUsers = make_users(args.users * 2)[args.users:]
+        client.users.extend(newUsers)
+        client.calls.clear()
+
+        def workload():
+            return [(client.send('!addme', user['id']), time.perf_counter()) for user in newUsers]
+
+        run_bot(client, workload)
+        added = sum(1 for user in newUsers if bot.store.get(user['id'], activeOnly=True))
+        methods = [method for method, kwargs, when in client.calls]
+
+        bot.team().web.limits = RATE_LIMITS
+        bot.team().web.buckets.clear()
+        throttled = make_users(args.users * 2 + 30)[args.users * 2:]
+        client.users.extend(throttled)
+        client.calls.clear()
+
+        def throttledWorkload():
+            for user in throttled:
+                client.send('!addme', user['id'])
+            return [(client.send('!status', client.users[0]['id']), time.perf_counter())]
+
+        def finished(sent):
+            marked = sum(1 for method, kwargs, when in client.calls if kwargs.get('name') == 'white_check_mark')
+            return sent[0][0]['channel'] in answer_times(client) and marked >= len(throttled)
+
+        sent = run_bot(client, throttledWorkload, finished)
+        status = answer_times(client)[sent[0][0]['channel']] - sent[0][1]
+        added += sum(1 for user in throttled if bot.store.get(user['id'], activeOnly=True))
+        bot.team().close()
+
+    print("Added " + str(added) + " of " + str(len(newUsers) + len(throttled)) + " new users")
+    print("users.list calls: " + str(methods.count('users.list')) + ", users.info calls: " + str(methods.count('users.info')))
+    print("!status behind %d rate limited lookups answered in %.3f seconds" % (len(throttled), status))
+    return added == len(newUsers) + len(throttled) and 'users.list' not in methods and status < 1
+
+def bench_commit(args):
+    '''
+    Everybody sends !active at once into a team.db on disk, first the old
+    way (rollback journal, a commit after every command) and then with
+    WAL and group commit, so we can see what the commits cost. '''
+
+    results = {}
+    for name, wal, delay in (('before', False, 0), ('after', True, bot.COMMIT_DELAY)):
+        with tempfile.TemporaryDirectory(dir='.') as tmp, settings(COMMIT_DELAY=delay):
+            client = setup_team(args.users, os.path.join(tmp, 'team.db'), wal)
+            client.calls.clear()
+
+            def workload():
+                return [(client.send('!active', user['id']), time.perf_counter()) for user in client.users]
+
+            sent = run_bot(client, workload)
+            bot.team().close()
+
+        answered = answer_times(client)
+        results[name] = len(answered) / (max(answered.values()) - sent[0][1])
+        print(name + ": %.1f commands per second" % results[name])
+
+    print("%.1fx faster" % (results['after'] / results['before']))
+    return True
+
+def bench_lateness(args):
+    '''
+    Works out lateness for a clock-in by every user on every day of the
+    last --days days, once with the schedule's lookup table and once
+    working each start time out from scratch. '''
+
+    schedule = Schedule(DEFAULT_SCHEDULE)
+    today = datetime.date.today()
+    stamps = []
+    for daysAgo in range(args.days):
+        morning = datetime.datetime.combine(today - datetime.timedelta(days=daysAgo), datetime.time(7)).timestamp()
+        stamps.extend(morning + random.uniform(0, 3 * 3600) for user in range(args.users))
+
+    start = time.perf_counter()
+    fast = [schedule.lateness(stamp) for stamp in stamps]
+    tableTime = time.perf_counter() - start
+
+    start = time.perf_counter()
+    slow = []
+    for stamp in stamps:
+        due = schedule.compute(datetime.date.fromtimestamp(stamp).toordinal(), None)
+        slow.append(0 if due is None or stamp < due else stamp - due)
+    scratchTime = time.perf_counter() - start
+
+    print("%d clock-ins: %.0f per second with the table, %.0f per second from scratch"
+          % (len(stamps), len(stamps) / tableTime, len(stamps) / scratchTime))
+    return fast == slow
+
+def bench_backfill(args):
+    '''
+    Fills the events table with --days days of clock-ins and clock-outs
+    for everybody, then times a backfill over all of it and checks the
+    totals against replaying the events one at a time. One person also
+    has 10 hours from before there were events, which have to be kept. '''
+
+    from backfill import backfill
+
+    with tempfile.TemporaryDirectory() as tmp:
+        setup_team(args.users, os.path.join(tmp, 'team.db'))
+        today = datetime.date.today()
+        events = []
+        for daysAgo in range(args.days, 0, -1):
+            morning = datetime.datetime.combine(today - datetime.timedelta(days=daysAgo), datetime.time(7)).timestamp()
+            for user in bot.store.active_users():
+                cameIn = morning + random.uniform(0, 3 * 3600)
+                events.append((user.id, 'in', cameIn, 0.0))
+                events.append((user.id, 'out', cameIn + random.uniform(3600, 6 * 3600), 0.0))
+        bot.c.executemany('INSERT INTO events (user, kind, timestamp, seconds) VALUES (?, ?, ?, ?)', events)
+        veteran = events[0][0]
+        bot.c.execute('UPDATE users SET totalTimeSpent=36000 WHERE id=?', (veteran,))
+        bot.conn.commit()
+
+        start = time.perf_counter()
+        count = backfill(bot.c, bot.schedule)
+        bot.conn.commit()
+        elapsed = time.perf_counter() - start
+
+        # The slow way, one event at a time
+        expected = {}
+        lastIn = {}
+        for userId, kind, stamp, seconds in sorted(events, key=lambda event: (event[0], event[2])):
+            late, worked = expected.get(userId, (0.0, 0.0))
+            if kind == 'in':
+                day = datetime.date.fromtimestamp(stamp)
+                if lastIn.get(userId, (None,))[0] != day:
+                    late += bot.schedule.lateness(stamp, userId)
+                lastIn[userId] = (day, stamp)
+            else:
+                worked += stamp - lastIn[userId][1]
+            expected[userId] = (late, worked)
+        expected[veteran] = (expected[veteran][0], expected[veteran][1] + 36000)
+        actual = dict((row[0], row[1:]) for row in bot.c.execute('SELECT id, totalTimeLate, totalTimeSpent FROM users'))
+        wrong = [userId for userId in expected if any(abs(a - b) > .001 for a, b in zip(expected[userId], actual[userId]))]
+        bot.team().close()
+
+    print("Backfilled %d events for %d users in %.2f seconds" % (count, args.users, elapsed))
+    if wrong:
+        print(str(len(wrong)) + " users don't match replaying the events one at a time")
+    return not wrong
+
+def bench_api(args):
+    '''
+    Sends a reply to every user through the Web API client against a local
+    stub server, once opening a new connection for every call the way a
+    bare requests.post does and once over the pooled session. Then checks
+    that a 429 gets waited out, that a burst of replies to one channel
+    goes out as one message when coalescing is on, that a method out of
+    calls doesn't hold up the others, and that an unreachable Slack comes
+    back as ok=False instead of an exception. '''
+
+    client = FakeSlackClient(users=make_users(args.users))
+    stub = FakeWebAPI(client)
+    web = SlackWebClient(None, baseUrl=stub.url, workers=bot.API_WORKERS, limits=NO_LIMITS)
+
+    start = time.perf_counter()
+    for user in client.users:
+        requests.post(stub.url + 'chat.postMessage', data={'channel': 'D' + user['id'][1:], 'text': 'Hi'})
+    unpooledTime = time.perf_counter() - start
+    unpooledConnections = stub.connections
+
+    start = time.perf_counter()
+    for user in client.users:
+        web.submit('chat.postMessage', channel='D' + user['id'][1:], text='Hi')
+    web.wait()
+    pooledTime = time.perf_counter() - start
+    pooledConnections = stub.connections - unpooledConnections
+    print("%d replies: %.0f per second on %d connections without the pool, %.0f per second on %d with it"
+          % (args.users, args.users / unpooledTime, unpooledConnections, args.users / pooledTime, pooledConnections))
+
+    stub.ratelimit('reactions.add', retryAfter=1)
+    start = time.perf_counter()
+    response = web.call('reactions.add', channel='D0000000', name='thumbsup')
+    waited = time.perf_counter() - start
+    print("Rate limited call came back ok=%s after %.2f seconds" % (response.get('ok'), waited))
+
+    coalescing = SlackWebClient(None, baseUrl=stub.url, limits=NO_LIMITS, coalesce=True)
+    client.calls.clear()
+    for i in range(10):
+        coalescing.submit('chat.postMessage', channel='D0000000', text=str(i))
+    coalescing.wait()
+    posts = [kwargs for method, kwargs, when in client.calls if method == 'chat.postMessage']
+    print("10 replies to one channel went out as %d message(s)" % len(posts))
+
+    # reactions.add runs out after 2 and then gets one a second, with a worker to spare for each
+    limited = SlackWebClient(None, baseUrl=stub.url, workers=2, limits={'default': (1e9, 1e9), 'reactions.add': (1.0, 2)})
+    for i in range(6):
+        limited.submit('reactions.add', channel='D0000000', name='thumbsup')
+    start = time.perf_counter()
+    limited.submit('chat.postMessage', channel='D0000000', text='Hi').result()
+    replied = time.perf_counter() - start
+    print("A reply behind 4 rate limited reactions went out in %.3f seconds" % replied)
+
+    unreachable = SlackWebClient(None, baseUrl='http://127.0.0.1:1/api/', limits=NO_LIMITS)
+    with contextlib.redirect_stderr(io.StringIO()):
+        failed = unreachable.submit('chat.postMessage', channel='D0000000', text='Hi').result()
+    print("Unreachable Slack came back ok=%s error=%s" % (failed.get('ok'), failed.get('error')))
+
+    web.close()
+    coalescing.close()
+    limited.close()
+    unreachable.close()
+    stub.close()
+    return (response.get('ok') and waited >= 1 and len(posts) == 1 and posts[0]['text'] == '\n'.join(map(str, range(10)))
+            and pooledConnections <= bot.API_WORKERS and replied < .5 and failed.get('ok') is False)
+
+def bench_outage(args):
+    '''
+    Half the team clocks in, then the connection drops and the other half
+    clocks in while it's down. The first few reconnects fail. Once it's
+    back Slack delivers the first half's messages all over again, and then
+    everybody clocks out. Every command should be handled exactly once, in
+    order, and we see how long it took to get going again. '''
+
+    with tempfile.TemporaryDirectory() as tmp, settings(RECONNECT_BASE=.05):
+        client = setup_team(args.users, os.path.join(tmp, 'team.db'))
+        client.failConnects = 3
+        client.calls.clear()
+        half = len(client.users) // 2
+
+        def workload():
+            sent = [client.send('!in', user['id']) for user in client.users[:half]]
+            # Let the bot see those before the connection goes
+            while len(answer_times(client)) < half:
+                time.sleep(.01)
+            client.drop()
+            dropped = time.perf_counter()
+            sent += [client.send('!in', user['id']) for user in client.users[half:]]
+            while not client.connected:
+                time.sleep(.01)
+            for event in sent[:half]:
+                client.push(event)
+            sent += [client.send('!out', user['id']) for user in client.users]
+            return [(event, dropped) for event in sent]
+
+        def finished(sent):
+            return sum(1 for method, kwargs, when in client.calls if method == 'reactions.add') >= len(sent)
+
+        sent = run_bot(client, workload, finished)
+        events = bot.c.execute('SELECT kind, COUNT(*) FROM events GROUP BY kind').fetchall()
+        stillIn = len(bot.store.clockedIn)
+        bot.team().close()
+
+    reactions = collections.Counter(kwargs['channel'] for method, kwargs, when in client.calls if method == 'reactions.add')
+    complaints = [kwargs['text'] for method, kwargs, when in client.calls if method == 'chat.postMessage' and 'already' in kwargs['text']]
+    caughtUp = [when for method, kwargs, when in client.calls if method == 'reactions.add'][half]
+    print("Sent %d commands, %d reactions, %d complaints, %d still clocked in" % (len(sent), sum(reactions.values()), len(complaints), stillIn))
+    print("Events: " + ", ".join("%s %d" % row for row in events))
+    print("First command from the outage answered %.2f seconds after the drop" % (caughtUp - sent[0][1]))
+    return (all(count == 2 for count in reactions.values()) and len(reactions) == len(client.users)
+            and not complaints and not stillIn)
+
+def bench_catchup(args):
+    '''
+    Starts the bot with Slack's real rate limits on a team of up to 60
+    where everybody but one clocked in while it was down, and that one
+    clocks in live as soon as it's up. Their DM's history gets read first,
+    so they hear back long before every DM has been read. Then the
+    connection drops before the rest have been read, and everybody else
+    still gets clocked in exactly once. '''
+
+    users = min(args.users, 60)
+    with tempfile.TemporaryDirectory() as tmp:
+        client = setup_team(users, os.path.join(tmp, 'team.db'))
+        bot.team().web.limits = RATE_LIMITS
+        bot.team().web.buckets.clear()
+        # The last thing handled before it went down, so it knows where to catch up from
+        down = time.time() - 10 * bot.CATCH_UP_MARGIN
+        last = client.send('!usage', 'U0000000', at=down)['ts']
+        bot.store.processed.add('D0000000', last)
+        bot.store.processed.catch_up_to(last)
+        bot.store.flush()
+        bot.conn.commit()
+        client.close()
+        *away, here = client.users
+        # Long enough ago that the catch-up margin doesn't cover them
+        for i, user in enumerate(away):
+            client.send('!in', user['id'], at=down + 1 + i * .01)
+        client.rtm_connect()
+        client.calls.clear()
+
+        def workload():
+            sent = [(client.send('!in', here['id']), time.perf_counter())]
+            # The live one being handled mustn't make the next catch-up skip the DMs this one didn't get to
+            while sent[0][0]['channel'] not in answer_times(client):
+                time.sleep(.01)
+            client.drop()
+            return sent
+
+        def finished(sent):
+            return sum(1 for method, kwargs, when in client.calls if method == 'reactions.add') >= users
+
+        start = time.perf_counter()
+        sent = run_bot(client, workload, finished)
+        clockedIn = len(bot.store.clockedIn)
+        bot.team().close()
+
+    answered = answer_times(client)
+    live = answered[sent[0][0]['channel']] - sent[0][1]
+    everybody = max(answered.values()) - start
+    print("Live clock-in answered in %.2f seconds, everybody caught up in %.2f seconds, %d of %d clocked in"
+          % (live, everybody, clockedIn, users))
+    return clockedIn == users and live < everybody / 4
+
+def bench_rollover(args):
+    '''
+    Everybody has a week of time on the books and the bot starts up having
+    missed the rollover, so it rolls the week over while commands trickle
+    in. Everybody's week should end up in the weeks table, the timesheet
+    should go to the leaders' channel, and the commands shouldn't wait. '''
+
+    with tempfile.TemporaryDirectory() as tmp:
+        client = setup_team(args.users, os.path.join(tmp, 'team.db'))
+        bot.c.execute('''UPDATE users SET timeLateThisWeek=600, timeSpentThisWeek=36000''')
+        lastWeek = time.time() - 8 * 24 * 3600
+        bot.c.execute('''INSERT INTO events (user, kind, timestamp, seconds) VALUES ('timebot', 'reset', ?, 0)''', (lastWeek,))
+        bot.conn.commit()
+        bot.team().reload()
+        bot.team().leader_channel_id = 'G0000000'
+        client.calls.clear()
+
+        def workload():
+            sent = []
+            for user in client.users:
+                time.sleep(random.expovariate(1.0 / args.gap))
+                sent.append((client.send('!status', user['id']), time.perf_counter()))
+            return sent
+
+        sent = run_bot(client, workload)
+        saved = bot.c.execute('SELECT COUNT(*) FROM weeks').fetchone()[0]
+        left = bot.c.execute('SELECT COUNT(*) FROM users WHERE timeLateThisWeek != 0 OR timeSpentThisWeek != 0').fetchone()[0]
+        bot.team().close()
+
+    answered = answer_times(client)
+    latencies = [(answered[event['channel']] - when) * 1000 for event, when in sent if event['channel'] in answered]
+    uploads = [kwargs for method, kwargs, when in client.calls if method == 'files.upload']
+    print("Saved %d weeks, %d users not reset, %d timesheet(s) sent to %s"
+          % (saved, left, len(uploads), ", ".join(upload['channels'] for upload in uploads)))
+    print("p50 %.2f ms, p99 %.2f ms" % (percentile(latencies, .5), percentile(latencies, .99)))
+    return saved == args.users and not left and [upload['channels'] for upload in uploads] == ['G0000000']
+
+def bench_sweep(args):
+    '''
+    A tenth of the team (up to 100 people) forgot to clock out yesterday,
+    and the rest aren't clocked in. Times one sweep for forgotten
+    clock-outs, which should take as long for 100 stale sessions
+    whatever the team size. Everybody stale should be clocked out with no
+    time and get a DM, and nobody else should be touched. '''
+
+    with tempfile.TemporaryDirectory() as tmp:
+        client = setup_team(args.users, os.path.join(tmp, 'team.db'))
+        stale = [user['id'] for user in client.users[:min(100, args.users // 10)]]
+        recent = [user['id'] for user in client.users[len(stale):2 * len(stale)]]
+        now = time.time()
+        bot.c.executemany('UPDATE users SET clockedIn=1, timeClockedInAt=? WHERE id=?', [(now - 24 * 3600, userId) for userId in stale])
+        bot.c.executemany('UPDATE users SET clockedIn=1, timeClockedInAt=? WHERE id=?', [(now - 3600, userId) for userId in recent])
+        bot.conn.commit()
+        bot.team().reload()
+        plan = bot.c.execute('EXPLAIN QUERY PLAN SELECT id FROM users WHERE clockedIn=1 AND timeClockedInAt < ?', (now,)).fetchall()
+        client.calls.clear()
+
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            swept = bot.sweep_sessions()
+        elapsed = time.perf_counter() - start
+        bot.wait_for_api_calls()
+        stillIn = set(row[0] for row in bot.c.execute('SELECT id FROM users WHERE clockedIn=1'))
+        spent = bot.c.execute('SELECT TOTAL(timeSpentThisWeek) FROM users').fetchone()[0]
+        bot.team().close()
+
+    dms = set(kwargs['channel'] for method, kwargs, when in client.calls if method == 'chat.postMessage')
+    print("Swept %d of %d users in %.2f ms (%s)" % (swept, args.users, elapsed * 1000, plan[0][-1]))
+    return swept == len(stale) and stillIn == set(recent) and dms == set(stale) and spent == 0
+
+def bench_rush(args):
+    '''
+    Replays a morning: everybody clocks in around their start time on the
+    last weekday, with arrivals spread out like real ones, sped up
+    --speedup times. We see how many commands per second get through, how
+    long each waits for an answer, and check the database ends up with
+    exactly the lateness the schedule says. '''
+
+    day = datetime.date.today()
+    while bot.schedule_for(bot.SCHEDULE_FILE).start(day) is None:
+        day -= datetime.timedelta(days=1)
+    due = bot.schedule_for(bot.SCHEDULE_FILE).start(day)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        client = setup_team(args.users, os.path.join(tmp, 'team.db'))
+        # Most people get there a little early, some are late, a few are very late
+        arrivals = sorted((due + random.gauss(-5 * 60, 10 * 60) + random.expovariate(1 / 120.0), user['id'])
+                          for user in client.users)
+        expected = sum(max(0, at - due) for at, userId in arrivals)
+        client.calls.clear()
+
+        def workload():
+            sent = []
+            start = time.perf_counter()
+            for at, userId in arrivals:
+                wait = (at - arrivals[0][0]) / args.speedup - (time.perf_counter() - start)
+                if wait > 0:
+                    time.sleep(wait)
+                sent.append((client.send('!in', userId, at=at), time.perf_counter()))
+            return sent
+
+        sent = run_bot(client, workload)
+        clockedIn, late, totalLate = bot.c.execute('''SELECT TOTAL(clockedIn), TOTAL(timeLateThisWeek > 0),
+                                                      TOTAL(timeLateThisWeek) FROM users''').fetchone()
+        events = bot.c.execute('''SELECT COUNT(*) FROM events WHERE kind='in' ''').fetchone()[0]
+        wrong = bot.store.check_totals()
+        bot.team().close()
+
+    answered = answer_times(client)
+    latencies = [(answered[event['channel']] - when) * 1000 for event, when in sent if event['channel'] in answered]
+    elapsed = max(answered.values()) - sent[0][1]
+    print("Replayed %d clock-ins from %s in %.1f seconds: %.1f commands per second"
+          % (len(sent), day, elapsed, len(answered) / elapsed))
+    print("p50 %.2f ms, p95 %.2f ms, p99 %.2f ms, max %.2f ms" % (percentile(latencies, .5), percentile(latencies, .95),
+          percentile(latencies, .99), max(latencies)))
+    print("%d clocked in, %d in events, %d late for %.0f minutes in all (expected %.0f)"
+          % (clockedIn, events, late, totalLate / 60, expected / 60))
+    if wrong:
+        print("Running totals don't match the database: " + ", ".join(wrong))
+    return (len(latencies) == len(sent) and clockedIn == events == len(sent)
+            and abs(totalLate - expected) < 1 and not wrong)
+
+def bench_analytics(args):
+    '''
+    Logs --days days of clock-ins and clock-outs for everybody through the
+    bot's event log, so the daily and monthly tables are kept up as they
+    go, and checks them against working them out from scratch. Then times
+    !history, !trend and !streak for everybody, once with nothing cached
+    and once cached, makes sure the streaks saved along the way come out
+    the same as working them out again, and makes sure a new event throws
+    away that person's cached answers. '''
+
+    from store import rebuild_rollups
+
+    with tempfile.TemporaryDirectory() as tmp:
+        client = setup_team(args.users, os.path.join(tmp, 'team.db'))
+        today = datetime.date.today()
+        for daysAgo in range(args.days, 0, -1):
+            day = today - datetime.timedelta(days=daysAgo)
+            due = bot.schedule.start(day)
+            if due is None:
+                continue
+            for user in bot.store.active_users():
+                cameIn = due + random.uniform(-1800, 1800)
+                bot.store.events.log(user.id, 'in', max(0, cameIn - due), cameIn)
+                bot.store.events.log(user.id, 'out', 4 * 3600, cameIn + 4 * 3600)
+            bot.store.flush()
+        bot.conn.commit()
+        tables = ('daily', 'monthly')
+        kept = [bot.c.execute('SELECT * FROM ' + table + ' ORDER BY 1, 2').fetchall() for table in tables]
+        rebuild_rollups(bot.c)
+        rebuilt = [bot.c.execute('SELECT * FROM ' + table + ' ORDER BY 1, 2').fetchall() for table in tables]
+        same = all(len(old) == len(new) and all(a[:2] == b[:2] and all(abs(x - y) < .001 for x, y in zip(a[2:], b[2:]))
+                                                for a, b in zip(old, new))
+                   for old, new in zip(kept, rebuilt))
+
+        commands = ('!history', '!trend', '!trend months', '!streak')
+        times = []
+        for attempt in range(2):
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                for user in client.users:
+                    for text in commands:
+                        bot.handle_command({'text': text, 'channel': 'D' + user['id'][1:], 'user': user['id'], 'ts': '0'})
+            times.append(time.perf_counter() - start)
+        bot.wait_for_api_calls()
+
+        workday = lambda ordinal: bot.schedule.start(datetime.date.fromordinal(ordinal)) is not None
+        today = today.toordinal()
+        saved = [bot.store.analytics.streak(user['id'], today, workday) for user in client.users]
+        bot.c.execute('DELETE FROM streaks')
+        fresh = [bot.store.analytics.streak(user['id'], today, workday) for user in client.users]
+
+        someone = client.users[0]['id']
+        before = len(bot.store.analytics.rendered.get(someone, {}))
+        bot.store.events.log(someone, 'in', 0.0)
+        after = len(bot.store.analytics.rendered.get(someone, {}))
+        bot.team().close()
+
+    count = len(client.users) * len(commands)
+    print("%d daily and %d monthly rows, %s building them from scratch" % (len(kept[0]), len(kept[1]), "same as" if same else "DIFFERENT from"))
+    print("%d commands: %.0f per second uncached, %.0f per second cached" % (count, count / times[0], count / times[1]))
+    print("saved streaks %s working them out again" % ("same as" if saved == fresh else "DIFFERENT from"))
+    return same and saved == fresh and before == len(commands) and after == 0
+
+def bench_workspaces(args):
+    '''
+    Serves 1, MAX_OPEN_SHARDS and then four times that many workspaces
+    from one process, each with --users people and a database of its
+    own, and has a few people on every team clock in at once. The last
+    team's shard won't open at first and its first connections to Slack
+    fail, so it falls over and gets started again, and keeps trying to
+    connect, while the others carry on. The API threads, HTTP connections
+    and open databases shouldn't grow with the number of teams, and past
+    MAX_OPEN_SHARDS each extra team should cost far less memory than one
+    with its shard open. Memory is what the bot's own modules are holding
+    once everybody has been answered, and tracing it slows everything
+    down, so the times are only for comparing with each other. Last, a
+    team over its rate limits queues more calls than there are API
+    threads, and another team's reply on the same threads should still go
+    out right away. '''
+
+    perTeam = 5
+    modules = ('bot.py', 'store.py', 'analytics.py', 'directory.py', 'workspace.py', 'slackapi.py')
+    results = {}
+    for count in (1, bot.MAX_OPEN_SHARDS, 4 * bot.MAX_OPEN_SHARDS):
+        tracemalloc.start()
+        with tempfile.TemporaryDirectory() as tmp, contextlib.redirect_stdout(io.StringIO()), \
+             settings(RESTART_DELAY=.05, RECONNECT_BASE=.05):
+            stub = FakeWebAPI(FakeSlackClient())
+            before = set(threading.enumerate())
+            executor = make_executor(bot.API_WORKERS)
+            session = make_session(bot.API_WORKERS)
+            workspaces = []
+            for i in range(count):
+                name = 'team%d' % i
+                client = FakeSlackClient(users=make_users(args.users))
+                stub.add(name, client)
+                api = SlackWebClient(name, baseUrl=stub.url, limits=NO_LIMITS, session=session, executor=executor)
+                workspace = bot.use_workspace(bot.Workspace(name, client, api, os.path.join(tmp, name + '.db'),
+                                                            bot.schedule_for(bot.SCHEDULE_FILE), bot.shards))
+                bot.initialize_db(workspace.dbName)
+                bot.c.execute('''UPDATE users SET active=1''')
+                bot.conn.commit()
+                workspace.reload()
+                client.rtm_connect()
+                workspaces.append(workspace)
+            # The last team's shard can't be opened at first, so it falls over and has to be started again,
+            # and Slack turns its first few connections away, so it has to keep trying
+            workspace.close()
+            workspace.connect = failing(workspace.connect, 2)
+            workspace.slack_client.close()
+            workspace.slack_client.failConnects = 2
+
+            def workload():
+                for workspace in workspaces:
+                    # Nobody's messages reach a team that isn't connected yet
+                    while not workspace.slack_client.connected:
+                        time.sleep(.01)
+                    for user in workspace.slack_client.users[:perTeam]:
+                        workspace.slack_client.send('!in', user['id'])
+
+            def answered():
+                return all(len(answer_times(workspace.slack_client)) >= perTeam for workspace in workspaces)
+
+            async def main():
+                loop = asyncio.get_event_loop()
+                server = asyncio.ensure_future(bot.serve(workspaces))
+                start = time.perf_counter()
+                await loop.run_in_executor(None, workload)
+                while not answered() and not server.done():
+                    await asyncio.sleep(.01)
+                elapsed = time.perf_counter() - start
+                snapshot = tracemalloc.take_snapshot()
+                server.cancel()
+                return elapsed, snapshot
+
+            elapsed, snapshot = asyncio.run(main())
+            memory = sum(stat.size for stat in snapshot.statistics('filename')
+                         if os.path.basename(stat.traceback[0].filename) in modules)
+            threads = sum(1 for thread in set(threading.enumerate()) - before if thread.name.startswith('slackapi'))
+            results[count] = (memory, threads, stub.connections, len(bot.shards.open), answered())
+            for workspace in workspaces:
+                workspace.web.wait()
+                workspace.slack_client.close()
+            bot.shards.close()
+            executor.shutdown()
+            session.close()
+            stub.close()
+        tracemalloc.stop()
+        print("%d workspaces: %d clock-ins answered in %.2f seconds, %.0f KB, %d API threads, %d connections, %d open shards"
+              % (count, count * perTeam, elapsed, memory / 1024.0, threads, results[count][2], results[count][3]))
+
+    # One team over its rate limits and told to back off mustn't hold up another team's reply on the same threads
+    stub = FakeWebAPI(FakeSlackClient())
+    executor = make_executor(bot.API_WORKERS)
+    session = make_session(bot.API_WORKERS)
+    throttled = SlackWebClient('throttled', baseUrl=stub.url, limits={'default': (1e9, 1e9), 'files.upload': (4.0, 1)},
+                               session=session, executor=executor)
+    other = SlackWebClient('other', baseUrl=stub.url, limits=NO_LIMITS, session=session, executor=executor)
+    stub.ratelimit('reactions.add', retryAfter=1, times=3 * bot.API_WORKERS)
+    for i in range(3 * bot.API_WORKERS):
+        throttled.submit('files.upload', channels='G0000000', content='timesheet')
+        throttled.submit('reactions.add', channel='D0000000', name='thumbsup')
+    start = time.perf_counter()
+    other.submit('chat.postMessage', channel='D0000001', text='Hi').result()
+    replied = time.perf_counter() - start
+    print("Another team's reply went out in %.3f seconds behind %d throttled calls" % (replied, 6 * bot.API_WORKERS))
+    throttled.close()
+    other.close()
+    executor.shutdown()
+    session.close()
+    stub.close()
+
+    small, open, many = sorted(results)
+    perOpen = (results[open][0] - results[small][0]) / float(open - small)
+    perClosed = (results[many][0] - results[open][0]) / float(many - open)
+    print("Each workspace costs %.1f KB with its shard open and %.1f KB without" % (perOpen / 1024.0, perClosed / 1024.0))
+    return (all(done and threads <= bot.API_WORKERS and connections <= bot.API_WORKERS and shards <= bot.MAX_OPEN_SHARDS
+                for memory, threads, connections, shards, done in results.values())
+            and perClosed < perOpen / 4 and replied < .5)
+
+BENCHMARKS = {
+    'workspaces': bench_workspaces,
+    'analytics': bench_analytics,
+    'rush': bench_rush,
+    'sweep': bench_sweep,
+    'rollover': bench_rollover,
+    'catchup': bench_catchup,
+    'outage': bench_outage,
+    'api': bench_api,
+    'backfill': bench_backfill,
+    'lateness': bench_lateness,
+    'commit': bench_commit,
+    'addme': bench_addme,
+    'burst': bench_burst,
+    'latency': bench_latency,
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run timebot benchmarks against a fake Slack team")
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS) + ['all'])
+    parser.add_argument('--users', type=int, default=500, help="How many users are on the team")
+    parser.add_argument('--days', type=int, default=365, help="How many days of history for lateness")
+    parser.add_argument('--gap', type=float, default=.005, help="Average seconds between commands for latency")
+    parser.add_argument('--command', default='!status', help="What everybody sends for latency")
+    parser.add_argument('--speedup', type=float, default=600, help="How many times faster than real time the rush morning goes")
+    args = parser.parse_args()
+
+    names = sorted(BENCHMARKS) if args.benchmark == 'all' else [args.benchmark]
+    failed = []
+    for name in names:
+        if len(names) > 1:
+            print("== " + name)
+        if not BENCHMARKS[name](args):
+            failed.append(name)
+    if len(names) > 1:
+        print("Failed: " + ", ".join(failed) if failed else "All passed")
+    if failed:
+        raise SystemExit(1)
@@ -1,13 +1,31 @@
 #!/usr/bin/python3
 
+import argparse
+import asyncio
+import codecs
+import collections
+import concurrent.futures
+import contextvars
 import csv
 import datetime
+import fcntl
+import logging
+import math
 import os
-import sqlite3
+import random
+import tempfile
 import time
 import websocket
 from slackclient import SlackClient
 
+import metrics
+from analytics import month_of, week_of
+from schedule import load_schedule
+from slackapi import SlackWebClient, make_executor, make_session
+from migrations import migrate
+from store import connect, sync_users
+from workspace import WORKSPACES_FILE, Shards, Workspace, load_workspaces
+
 # This code is inspired by https://www.fullstackpython.com/blog/build-first-slack-bot-python.html
 # Visit that webpage to get the whole setup guide
 
@@ -16,47 +34,279 @@ BOT_ID = os.environ.get("BOT_ID")
 
 # Channel to put the csv into
 leader_channel = "subteamleads"
-leader_channel_id = None
-# instantiate Slack & Twilio clients
-slack_client = SlackClient(os.environ.get('SLACK_BOT_TOKEN'))
 
-def initialize_db():
+# Where the team's data lives, if workspaces.json doesn't say
+DB_NAME = 'team.db'
+
+# When everybody is supposed to come in
+SCHEDULE_FILE = 'schedule.json'
+
+# How many people show up in !standings and !workstandings
+STANDINGS_SIZE = 5
+
+# Most commands we hold between reading them off the socket and handling them.
+# If a burst fills it up we stop reading until there's room again.
+MAX_QUEUED_COMMANDS = 256
+
+# What !report can put in the timesheet, keyed by (week or semester, late or worked)
+REPORT_COLUMNS = collections.OrderedDict([
+    (('week', 'late'), ('timeLateThisWeek', 'Late this week')),
+    (('week', 'worked'), ('timeSpentThisWeek', 'Worked this week')),
+    (('semester', 'late'), ('totalTimeLate', 'Late this semester')),
+    (('semester', 'worked'), ('totalTimeSpent', 'Worked this semester')),
+])
+
+# How far back !history and !trend go if you don't say, and the most they'll go
+HISTORY_DAYS = 7
+MAX_HISTORY_DAYS = 60
+TREND_WEEKS = 8
+MAX_TREND_WEEKS = 52
+TREND_MONTHS = 6
+MAX_TREND_MONTHS = 24
+
+# Timesheets bigger than this go to a temporary file instead of staying in memory
+REPORT_MEMORY_LIMIT = 1024 * 1024
+
+# Writes from a burst of commands are committed together, at most this
+# many seconds after the first one. Every command at least marks its
+# message handled, so nothing gets handled twice.
+COMMIT_DELAY = .05
+
+# We wake up as soon as the websocket has something for us, but check in
+# this often anyway in case the SSL layer is sitting on data already read
+RTM_IDLE_TIMEOUT = 5
+
+# If Slack has been quiet this long we ping it, and if it's quiet for twice
+# as long we give up on the connection and make a new one
+PING_INTERVAL = 30
+
+# Reconnecting waits a random time up to RECONNECT_BASE * 2 ** tries
+# seconds between attempts, but never more than RECONNECT_MAX
+RECONNECT_BASE = 1
+RECONNECT_MAX = 300
+
+# After reconnecting (or starting up) we read back through the DMs from a
+# little before the last message we handled, since messages from different
+# channels can come in slightly out of order. Anything we already handled
+# gets skipped.
+CATCH_UP_MARGIN = 60
+CATCH_UP_PAGE_SIZE = 200
+
+# How many DM histories get read at once while catching up, so the API
+# workers are still there for replies
+CATCH_UP_WORKERS = 2
+
+# Anybody clocked in longer than this gets clocked out, checked every SWEEP_INTERVAL seconds
+MAX_SESSION_HOURS = 12
+SWEEP_INTERVAL = 600
+
+# The most seconds the week rollover sleeps before checking the clock again
+ROLLOVER_CHECK = 3600
+# How long to wait before trying a rollover that failed again
+ROLLOVER_RETRY = 60
+
+# A workspace that falls over gets started again after this many seconds, without touching the others
+RESTART_DELAY = 5
+
+# Slack Web API calls run on these threads so they don't hold up the next command
+API_WORKERS = 4
+
+# Whether replies to the same channel that come out together get sent as one message
+COALESCE_REPLIES = False
+
+# Where /metrics is served, on localhost. 0 turns it off.
+METRICS_PORT = 9108
+
+# How many workspaces keep their database open and their users in memory at
+# once. Anything past that is closed and read back in when it's next used.
+MAX_OPEN_SHARDS = 16
+
+log = logging.getLogger('timebot')
+
+# What gets served on /metrics
+COMMAND_SECONDS = metrics.Histogram('timebot_command_seconds',
+        "Time spent on each command in parse (reading the arguments), db (running the handler) and api (each Slack call it made)",
+        ('command', 'phase'))
+COMMIT_SECONDS = metrics.Histogram('timebot_commit_seconds', "Time spent committing to the database")
+COMMANDS_HANDLED = metrics.Counter('timebot_commands_total', "Commands handled", ('command',))
+COMMAND_ERRORS = metrics.Counter('timebot_command_errors_total', "Commands that raised an exception", ('command',))
+RECONNECTS = metrics.Counter('timebot_reconnects_total', "Times we reconnected to Slack", ('result',))
+DROPPED_EVENTS = metrics.Counter('timebot_dropped_events_total', "Commands read from Slack that were never handled")
+QUEUE_DEPTH = metrics.Gauge('timebot_queue_depth', "Commands waiting to be handled", ('workspace',))
+CLOCKED_IN = metrics.Gauge('timebot_clocked_in_users', "Active users who are clocked in", ('workspace',))
+HEALTH = metrics.Gauge('timebot_health', "1 for the state each workspace's connection to Slack is in", ('workspace', 'state'))
+OPEN_SHARDS = metrics.Gauge('timebot_open_shards', "Workspaces with their database open")
+CAUGHT_UP = metrics.Counter('timebot_caught_up_commands_total', "Commands found in DM history after a reconnect")
+DUPLICATES = metrics.Counter('timebot_duplicate_commands_total', "Messages that were already handled and got skipped")
+
+# How a connection to Slack is doing: starting, connected, reconnecting or catching up
+HEALTH_STATES = ('starting', 'connected', 'reconnecting', 'catching up')
+
+# The command being handled right now, so its Slack calls get timed under it
+current_command = None
+
+# The workspace whatever is running right now is for. Each workspace's
+# tasks set it for themselves (see serve()), so the handlers never have to
+# be told which team they're working on.
+current_workspace = contextvars.ContextVar('current_workspace')
+
+# Every workspace's shard goes through here, so only MAX_OPEN_SHARDS are open at once
+shards = Shards(MAX_OPEN_SHARDS)
+OPEN_SHARDS.set_function(lambda: len(shards.open))
+
+# Schedule files already read, so workspaces sharing one share the Schedule
+schedules = {}
+
+# !addme commands waiting on Slack to say who somebody is (see add_user)
+lookups = set()
+
+def team():
+    # The workspace being served right now
+    return current_workspace.get()
+
+class Current(object):
+    '''
+    Stands in for one of the current workspace's things, so handlers can
+    keep saying store.get() or web.submit() and get their own team's. The
+    database ones open the workspace's shard if it was closed. '''
+
+    def __init__(self, name, database=False):
+        self.name = name
+        self.database = database
+
+    def __getattr__(self, attribute):
+        workspace = team().open() if self.database else team()
+        return getattr(getattr(workspace, self.name), attribute)
+
+# Who we talk to Slack through, set by use_workspace(). slack_client is the
+# RTM connection: anything with rtm_connect(), rtm_read() and
+# server.websocket.sock (and server.ping() and server.connected) like
+# SlackClient. web is the Web API: anything with call(), submit() and
+# wait() like SlackWebClient. Nothing is connected just by importing the
+# bot, so it can be run against a fake Slack (see fakeslack.py).
+slack_client = Current('slack_client')
+web = Current('web')
+directory = Current('directory')
+schedule = Current('schedule')
+conn = Current('conn', database=True)
+c = Current('c', database=True)
+store = Current('store', database=True)
+
+def use_workspace(workspace):
+    # Makes workspace the current one, here and in any task started from here
+    current_workspace.set(workspace)
+    return workspace
+
+def use_slack(rtm, api, dbName=DB_NAME):
+    # Points the bot at a single team with a Slack connection, a Web API client and a database
+    return use_workspace(Workspace('default', rtm, api, dbName, schedule_for(SCHEDULE_FILE), shards,
+                                   leader_channel, BOT_ID, STANDINGS_SIZE))
+
+def connect_slack(token):
+    # The real Slack. The RTM connection goes through SlackClient and every Web API call through our own pooled client.
+    return use_slack(SlackClient(token), SlackWebClient(token, workers=API_WORKERS, coalesce=COALESCE_REPLIES))
+
+def schedule_for(fileName):
+    if fileName not in schedules:
+        schedules[fileName] = load_schedule(fileName)
+    return schedules[fileName]
+
+def connect_workspaces(configs):
+    '''
+    The real Slack for every workspace in configs (see load_workspaces).
+    Each gets its own RTM connection and rate limits, but their Web API
+    calls all go through one pool of API_WORKERS threads and connections. '''
+
+    executor = make_executor(API_WORKERS)
+    session = make_session(API_WORKERS)
+    workspaces = []
+    for config in configs:
+        token = config.get('token') or os.environ.get(config.get('tokenVariable', 'SLACK_BOT_TOKEN'))
+        api = SlackWebClient(token, workers=API_WORKERS, coalesce=COALESCE_REPLIES, session=session, executor=executor)
+        workspaces.append(Workspace(config['name'], SlackClient(token), api, config['database'],
+                                    schedule_for(config.get('schedule', SCHEDULE_FILE)), shards,
+                                    config.get('leaders', leader_channel), config.get('botId', BOT_ID), STANDINGS_SIZE))
+    return workspaces
+
+def initialize_db(dbName=DB_NAME):
+    '''
+    Creates the database or upgrades it to the newest schema, then adds
+    anybody new on Slack and renames anybody whose name changed. Nobody's
+    time gets thrown away. '''
+
     # Open up the database
-    conn = sqlite3.connect('team.db')
+    conn = connect(dbName)
     c = conn.cursor()
+    migrate(conn)
 
-    try:
-        c.execute(''' DROP TABLE IF EXISTS users''')
-    except sqlite3.OperationalError:
-        # Make sure it doesn't crash
-        pass
-    c.execute('''CREATE TABLE users (id TEXT, realName TEXT, checkInDate INTEGER, timeLateThisWeek REAL, totalTimeLate REAL, 
-                                    clockedIn INTEGER, timeClockedInAt REAL, timeSpentThisWeek REAL, totalTimeSpent REAL, active INTEGER)''')
-
-    count = 0
-    if slack_client.rtm_connect():
-        output = slack_client.api_call("users.list")
-        if output:
-            for user in output['members']:
-                if not user['is_bot']:
-                    count += 1
-                    print( user['id'])
-                    print( user['name'])
-                    c.execute('INSERT INTO users VALUES (?, ?, 0, 0.0, 0.0, 0, 0.0, 0.0, 0.0, 0)', (user['id'], user['name']))
-
-            print( "Found " + str(count) + " users and added them to database.")
-        else:
-            print("I didn't get a list of users. Something is wrong.")
+    output = list(directory.all_users())
+    if output:
+        added, renamed = sync_users(c, output)
+        log.info("synced users found=%d added=%d renamed=%d", len(output), added, renamed)
     else:
-        print("Connection failed. Invalid Slack token or bot ID?")
+        log.error("didn't get a list of users, something is wrong")
 
     conn.commit()
+    conn.close()
 
-    print("User Table:")
-    for row in c.execute('''SELECT * FROM users'''):
-        print(row)
+def backfill_db(dbName=DB_NAME):
+    '''
+    Replays every clock event against the current schedule and corrects
+    everybody's totals by however much their events changed, for when the
+    schedule changes or somebody's times need fixing. Totals from before
+    the events table existed are kept. '''
 
-    conn.close()
+    # NumPy is only needed for this, so the bot can run without it
+    from backfill import backfill
+
+    if not os.path.isfile(dbName):
+        log.error("nothing to backfill db=%s", dbName)
+        return
+    # The bot writes the totals it has in memory back over whatever we'd work out
+    lock = lock_database(dbName)
+    if lock is None:
+        log.error("the bot is running on this database, stop it before backfilling db=%s", dbName)
+        return
+
+    with lock:
+        conn = connect(dbName)
+        c = conn.cursor()
+        migrate(conn)
+        start = datetime.datetime.now()
+        count = backfill(c, schedule)
+        conn.commit()
+        conn.close()
+    log.info("backfilled events=%d elapsed=%s", count, datetime.datetime.now() - start)
+
+def lock_database(dbName):
+    '''
+    Takes the lock that says something is writing dbName, so the bot and
+    a backfill never run on it at the same time. Returns the lock file,
+    which holds it until it's closed or the process exits, or None if
+    somebody else has it. '''
+
+    f = open(dbName + '.lock', 'w')
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        f.close()
+        return None
+    return f
+
+def api_call(method, **kwargs):
+    """
+    Sends a Slack Web API call in the background and returns a future for
+    the response, so the next command doesn't wait on Slack to answer.
+    """
+    name = current_command or 'none'
+    start = time.perf_counter()
+    future = web.submit(method, **kwargs)
+    future.add_done_callback(lambda future: COMMAND_SECONDS.observe(time.perf_counter() - start, command=name, phase='api'))
+    return future
+
+def wait_for_api_calls(timeout=None):
+    # Blocks until every call we've sent off so far is done
+    web.wait(timeout)
 
 def toTime(seconds):
     '''
@@ -72,24 +322,14 @@ def toTime(seconds):
         text = str(seconds) + " seconds"
     return text
 
-def getStartingTime():
-    today = datetime.date.today()
-
-    # Weekday besides Wednesday
-    if today.weekday() in [0, 1, 3, 4]:
-        hourToBegin = 8
-        minuteToBegin = 0
-    # Wednesday
-    elif today.weekday() == 2:
-        hourToBegin = 7
-        minuteToBegin = 30
-    # Weekend
+def day_off(command):
+    # Lets them know they came in when they didn't have to
+    if datetime.date.today().weekday() >= 5:
+        text = "Why are you coming in on the weekend???"
     else:
-        slack_client.api_call("chat.postMessage", channel=command['channel'], 
-                text="Why are you coming in on the weekend???", as_user = True)
-        return datetime.datetime.now()
-
-    return datetime.datetime(today.year, today.month, today.day, hour=hourToBegin, minute=minuteToBegin)
+        text = "You don't have to be here today, so you're not late!"
+    api_call("chat.postMessage", channel=command['channel'], 
+            text=text, as_user = True)
 
 def handle_command(command):
     """
@@ -97,469 +337,1101 @@ def handle_command(command):
     are valid commands. If so, then acts on the commands. If not,
     returns back what it needs for clarification.
     """
+    start = time.perf_counter()
+    words = command['text'].split()
+    entry = COMMANDS.get(words[0])
+    isDirectMessage = command['channel'][0] == 'D'
 
-    # Clocks in late
-    if command['text'].startswith('!intime') and command['channel'][0] == 'D':
-        in_late(command)
-
-    # Clock in
-    elif command['text'].startswith('!in') and command['channel'][0] == 'D':
-        clock_in(command)
-
-    # Reset the week
-    elif command['text'].startswith('!!reset') and command['channel'][0] == 'D':
-        reset(command)
-
-    # Mark as active
-    elif command['text'].startswith('!active') and command['channel'][0] == 'D':
-        active(command)
-
-    # Mark as inactive
-    elif command['text'].startswith('!inactive') and command['channel'][0] == 'D':
-        inactive(command)
-
-    # Shows how late you are and how much time you've spent this week
-    elif command['text'].startswith('!status') and command['channel'][0] == 'D':
-        status(command)
-
-    elif command['text'].startswith('!outtime') and command['channel'][0] == 'D':
-        out_late(command)
-
-    elif command['text'].startswith('!out') and command['channel'][0] == 'D':
-        clock_out(command)
-
-    elif command['text'].startswith('!addme') and command['channel'][0] == 'D':
-        add_user(command)
-
-    # Show current standings. Latest and time spent
-    elif command['text'].startswith('!standings'):
-        get_standings(command)
-
-    elif command['text'].startswith('!report') and command['channel'][0] == 'D':        
-        report(command)
-
-    
-    elif command['text'].startswith('!lateweek'):
-        rows = c.execute('''SELECT timeLateThisWeek FROM users WHERE active=1''')
-        totalTime = 0.0
-        for row in rows:
-            totalTime += row[0]
-
-        slack_client.api_call("chat.postMessage", channel=command["channel"], as_user=True,
-                text="The total time that we've been late this week is " + toTime(totalTime) + ".")
-
-    elif command['text'].startswith('!latesemester'):
-        rows = c.execute('''SELECT totalTimeLate FROM users WHERE active=1''')
-        totalTime = 0.0
-        for row in rows:
-            totalTime += row[0]
-
-        slack_client.api_call("chat.postMessage", channel=command["channel"], as_user=True,
-                text="The total time that we've been late this semester is " + toTime(totalTime) + ".")
-
-    elif command['text'].startswith('!workweek'):
-        rows = c.execute('''SELECT timeSpentThisWeek FROM users WHERE active=1''')
-        totalTime = 0.0
-        for row in rows:
-            totalTime += row[0]
-
-        slack_client.api_call("chat.postMessage", channel=command["channel"], as_user=True,
-                text="The total time that we've been hard at work this week is " + toTime(totalTime) + ".")
-
-    elif command['text'].startswith('!worksemester'):
-        rows = c.execute('''SELECT totalTimeSpent from users where active=1''')
-        totalTime = 0.0
-        for row in rows:
-            totalTime += row[0]
-
-        slack_client.api_call("chat.postMessage", channel=command["channel"], as_user=True,
-                text="The total time that we've been hard at work this semester is  " + toTime(totalTime) + ".")
-
-
-    # Shows who hasn't clocked in
-    elif command['text'].startswith('!attendance'):
-        # Return the list of people that aren't here
-        message = "These people haven't clocked in yet today:\n"
-        rows = c.execute('''SELECT realName, checkInDate FROM users WHERE checkInDate != ? AND active = 1 ORDER BY checkInDate DESC''', (datetime.date.today().toordinal(),))
-
-        for row in rows:
-            message += "*" + row[0] + "*: " + str(datetime.date.today().toordinal() - row[1])
-            message += " day ago\n" if datetime.date.today().toordinal() - row[1] == 1 else " days ago\n"
-
-        slack_client.api_call("chat.postMessage", channel=command["channel"], as_user=True,
-                text=message)
-
-
-    # Get the usage
-    elif command['text'].startswith('!usage'):
-        # If it's a direct message
-        if command['channel'][0] == 'D':
-            text=privateUsage()
-            
-        # If it's in a regular channel
-        else:
-            text=publicUsage()
-
-        slack_client.api_call("chat.postMessage", channel=command["channel"], as_user=True,
-                text=text)
-
-    else:
+    if entry is None or (entry.private and not isDirectMessage):
         # Unknown command, print usage statement
+        api_call("chat.postMessage", channel=command["channel"], as_user=True,
+                text="I don't understand " + command['text'] + ". " + usage_for(isDirectMessage))
+        return
 
-        # If it's a direct message
-        if command['channel'][0] == 'D':
-            text="I don't understand " + command['text'] + ". " + privateUsage()
-            
-        # If it's in a regular channel
-        else:
-            text="I don't understand " + command['text'] + ". " + publicUsage()
-
-        slack_client.api_call("chat.postMessage", channel=command["channel"], as_user=True,
-                text=text)
-
-    conn.commit()
+    if entry.parse:
+        try:
+            command['args'] = entry.parse(words[1:])
+        except (ValueError, IndexError):
+            api_call("chat.postMessage", channel=command['channel'], as_user=True,
+                    text="Invalid usage. " + entry.usage)
+            return
+    parsed = time.perf_counter()
+    COMMAND_SECONDS.observe(parsed - start, command=words[0], phase='parse')
+
+    entry.handler(command)
+    COMMAND_SECONDS.observe(time.perf_counter() - parsed, command=words[0], phase='db')
+
+def command_name(command):
+    # The command's first word, for labeling metrics. Anything we don't know is 'unknown' so there's a fixed number of them
+    words = command['text'].split()
+    return words[0] if words and words[0] in COMMANDS else 'unknown'
+
+def usage_for(isDirectMessage):
+    # DMs can do everything, public channels only get the public commands
+    return privateUsage() if isDirectMessage else publicUsage()
 
 def publicUsage():
-       return ("I can only do this in public channels:\n"
-                + "*!standings*: View current standings for the week\n"
-                + "*!attendance*: See who hasn't clocked in today\n"
-                + "*!workweek*: See the cumulative time that people have worked this week\n"
-                + "*!worksemester*: See the cumulative time that people have worked this semester\n"
-                + "*!lateweek*: See the cumulative time that people have been late this week\n"
-                + "*!latesemester*: See the cumulative time that people have been late this semester\n"
-                + "*!usage*: This usage statement")
+    return "I can only do this in public channels:\n" + "\n".join(
+            entry.usage for entry in COMMANDS.values() if entry.usage and not entry.private)
 
 def privateUsage():
-    return ("Try one of these:\n"
-                + "*!in*: Clock in\n"
-                + "*!intime number*: Clock in being _number_ minutes late. (For when you forget to clock in). Ex: !intime 5\n"
-                + "*!out*: Clock out\n"
-                + "*!outtime number*: Clock out having worked _number_ hours. Ex: !outtime 2 (worked 2 hours)\n"
-                + "*!active*: Mark yourself active\n"
-                + "*!status*: See your current late time this week\n"
-                + "*!sumtime*: See the cumulative time that people have been late this week\n"
-                + "*!attendance*: See who hasn't clocked in yet today\n"
-                + "*!usage*: This usage statement")
+    return "Try one of these:\n" + "\n".join(
+            entry.usage for entry in COMMANDS.values() if entry.usage)
+
+def sent_at(command):
+    # When the message was sent, which is when we count it as happening even if we only got it after an outage
+    return float(command['ts'])
 
 def clock_in(command):
     if any(char.isdigit() for char in command['text']):
-        slack_client.api_call("chat.postMessage", channel=command['channel'], 
+        api_call("chat.postMessage", channel=command['channel'], 
                 text="I noticed you included a number in your message. Did you mean to do *!intime*?", as_user = True) 
         return
-        
 
-    # There's an issue here, but I don't know what it is.
-    startTime = getStartingTime()
-    difference = datetime.datetime.now() - startTime
-
-    if difference.total_seconds() < 0:
-        # You weren't late, so there's no need to update the table.
-        delta = 0
-    else:
-        delta = difference.total_seconds()
-
-    timeLateThisWeek = c.execute('''SELECT timeLateThisWeek, totalTimeLate, clockedIn, timeClockedInAt, realName, checkInDate FROM users WHERE id=? AND active=1''', (command['user'],))
-    row = timeLateThisWeek.fetchone()
+    now = sent_at(command)
+    today = datetime.date.fromtimestamp(now)
+    user = store.get(command['user'], activeOnly=True)
     
-    if not row:
-        slack_client.api_call("chat.postMessage", channel=command['channel'],
+    if not user:
+        api_call("chat.postMessage", channel=command['channel'],
                 text="You are not in the database or you're not marked active. Talk to an administrator.", as_user=True)
         return
 
-    elif row[5] == datetime.date.today().toordinal():
-        c.execute('''UPDATE users SET timeClockedInAt=?, clockedIn=1 WHERE id=?''', 
-                                        (datetime.datetime.now().timestamp(),
-                                        command['user'],))
+    elif user.clockedIn == 1:
+        # Clocking in again would throw away when they really came in
+        api_call("chat.postMessage", channel=command['channel'],
+                text="You are already clocked in!", as_user=True)
+
+    elif user.checkInDate == today.toordinal():
+        store.update(user, timeClockedInAt=now, clockedIn=1)
+        store.events.log(user.id, 'in', 0.0, now)
 
-        slack_client.api_call("reactions.add", channel=command['channel'], 
+        api_call("reactions.add", channel=command['channel'], 
             name='thumbsup', timestamp=command['ts'])
-        print(str(datetime.datetime.now()) + ": " + str(row[4]) + ' clocked in again')
+        log.info("clocked in again user=%s name=%s", user.id, user.realName)
     
-    elif row[2] != 1:
-        c.execute('''UPDATE users SET timeLateThisWeek=?, totalTimeLate=?, timeClockedInAt=?, checkInDate=?, clockedIn=1 WHERE id=?''', 
-                                        (row[0] + delta, 
-                                        row[1] + delta, 
-                                        datetime.datetime.now().timestamp(),
-                                        datetime.date.today().toordinal(), 
-                                        command['user'],))
-
-        slack_client.api_call("reactions.add", channel=command['channel'], 
-            name='thumbsup', timestamp=command['ts'])
-        print(str(datetime.datetime.now()) + ": " + str(row[4]) + ' clocked in')
     else:
-        slack_client.api_call("chat.postMessage", channel=command['channel'],
-                text="You are already clocked in!", as_user=True)
+        if schedule.start(today, user.id) is None:
+            day_off(command)
+
+        delta = schedule.lateness(now, user.id)
+        store.update(user, timeLateThisWeek=user.timeLateThisWeek + delta,
+                           totalTimeLate=user.totalTimeLate + delta,
+                           timeClockedInAt=now,
+                           checkInDate=today.toordinal(),
+                           clockedIn=1)
+        store.events.log(user.id, 'in', delta, now)
+
+        api_call("reactions.add", channel=command['channel'], 
+            name='thumbsup', timestamp=command['ts'])
+        log.info("clocked in user=%s name=%s late=%.0f", user.id, user.realName, delta)
 
 def in_late(command):
 
-    today = datetime.date.today()
+    today = datetime.date.fromtimestamp(sent_at(command))
 
-    try:
-        minutesLate = int(command['text'].split(' ')[1])
-    except:
-        slack_client.api_call("chat.postMessage", channel=command['channel'], 
-                text="Invalid usage. Put the number of minutes late after *!intime*.", as_user = True)
-        return
-
-    secondsLate = minutesLate * 60
+    secondsLate = command['args'] * 60
     
     if secondsLate < 0:
         # You weren't late, so there's no need to update the table.
         secondsLate = 0
 
-    timeLateThisWeek = c.execute('''SELECT timeLateThisWeek, totalTimeLate, clockedIn, realName FROM users WHERE id=? AND active=1''', (command['user'],))
-    row = timeLateThisWeek.fetchone()
+    user = store.get(command['user'], activeOnly=True)
 
-    if not row:
-        slack_client.api_call("chat.postMessage", channel=command['channel'],
+    if not user:
+        api_call("chat.postMessage", channel=command['channel'],
                 text="You are not in the database or inactive. Talk to an administrator.", as_user=True)
         return
-    if row[2] != 1:
-        c.execute('''UPDATE users SET timeLateThisWeek=?, totalTimeLate=?, timeClockedInAt=?, checkInDate=?, clockedIn=1 WHERE id=?''', 
-                                        (row[0] + secondsLate, 
-                                        row[1] + secondsLate, 
-                                        datetime.datetime(today.year, today.month, today.day, hour=getStartingTime().hour + secondsLate // 3600,
-                                                            minute=getStartingTime().minute + (secondsLate % 3600) // 60,
-                                                            second=secondsLate % 3600 % 60).timestamp(),
-                                        datetime.date.today().toordinal(), 
-                                        command['user'],))
-
-        slack_client.api_call("reactions.add", channel=command['channel'], 
+    if user.clockedIn != 1:
+        startTime = schedule.start(today, user.id)
+        if startTime is None:
+            # No start time today, so they can't be late
+            day_off(command)
+            startTime = sent_at(command)
+            secondsLate = 0
+
+        store.update(user, timeLateThisWeek=user.timeLateThisWeek + secondsLate,
+                           totalTimeLate=user.totalTimeLate + secondsLate,
+                           timeClockedInAt=startTime + secondsLate,
+                           checkInDate=today.toordinal(),
+                           clockedIn=1)
+        store.events.log(user.id, 'in', secondsLate, user.timeClockedInAt)
+
+        api_call("reactions.add", channel=command['channel'], 
             name='thumbsup', timestamp=command['ts'])
 
-        print(str(datetime.datetime.now()) + ": " + str(row[3]) + ' clocked in with !intime')
+        log.info("clocked in with !intime user=%s name=%s", user.id, user.realName)
     else:
-        slack_client.api_call("chat.postMessage", channel=command['channel'],
+        api_call("chat.postMessage", channel=command['channel'],
                 text="You already clocked in today!", as_user=True)
 
 def clock_out(command):
     if any(char.isdigit() for char in command['text']):
-        slack_client.api_call("chat.postMessage", channel=command['channel'], 
+        api_call("chat.postMessage", channel=command['channel'], 
                 text="I noticed you included a number in your message. Did you mean to do *!outtime*?", as_user = True) 
         return
 
-    currentRow = c.execute('''SELECT timeSpentThisWeek, totalTimeSpent, clockedIn, timeClockedInAt, realName FROM users WHERE id=? AND active=1''', (command['user'],))
-    row = currentRow.fetchone()
+    user = store.get(command['user'], activeOnly=True)
     
-    if not row:
-        slack_client.api_call("chat.postMessage", channel=command['channel'],
+    if not user:
+        api_call("chat.postMessage", channel=command['channel'],
                 text="You are not in the database or you're not marked active. Talk to an administrator.", as_user=True)
         return
 
-    delta = datetime.datetime.now().timestamp() - float(row[3]) # Time spent in seconds
+    now = sent_at(command)
+    delta = now - float(user.timeClockedInAt) # Time spent in seconds
     
-    if row[2] != 0:
-        c.execute('''UPDATE users SET timeSpentThisWeek=?, totalTimeSpent=?, clockedIn=0 WHERE id=?''', 
-                                        (row[0] + delta, 
-                                        row[1] + delta, 
-                                        command['user'],))
+    if user.clockedIn != 0:
+        store.update(user, timeSpentThisWeek=user.timeSpentThisWeek + delta,
+                           totalTimeSpent=user.totalTimeSpent + delta,
+                           clockedIn=0)
+        store.events.log(user.id, 'out', delta, now)
 
-        slack_client.api_call("reactions.add", channel=command['channel'], 
+        api_call("reactions.add", channel=command['channel'], 
             name='thumbsup', timestamp=command['ts'])
-        print(str(datetime.datetime.now()) + ": " + str(row[4]) + ' clocked out')
+        log.info("clocked out user=%s name=%s", user.id, user.realName)
     else:
-        slack_client.api_call("chat.postMessage", channel=command['channel'],
+        api_call("chat.postMessage", channel=command['channel'],
                 text="You are already clocked out!", as_user=True)
 
 def out_late(command):
+    hoursSpent = command['args']
 
-    try:
-        hoursSpent = float(command['text'].split(' ')[1])
-    except:
-        slack_client.api_call("chat.postMessage", channel=command['channel'], 
-                text="Invalid usage. Put the number of hours spent after *!outtime*.", as_user = True)
-        return
-
-    currentRow = c.execute('''SELECT timeSpentThisWeek, totalTimeSpent, clockedIn, timeClockedInAt, realName FROM users WHERE id=? AND active=1''', (command['user'],))
-    row = currentRow.fetchone()
+    user = store.get(command['user'], activeOnly=True)
     
-    if not row:
-        slack_client.api_call("chat.postMessage", channel=command['channel'],
+    if not user:
+        api_call("chat.postMessage", channel=command['channel'],
                 text="You are not in the database or you're not marked active. Talk to an administrator.", as_user=True)
         return
 
     delta = hoursSpent * 3600 # Change it to seconds
     
-    if row[2] != 0:
-        c.execute('''UPDATE users SET timeSpentThisWeek=?, totalTimeSpent=?, clockedIn=0 WHERE id=?''', 
-                                        (row[0] + delta, 
-                                        row[1] + delta, 
-                                        command['user'],))
-
-        slack_client.api_call("reactions.add", channel=command['channel'], 
+    if user.clockedIn != 0:
+        store.update(user, timeSpentThisWeek=user.timeSpentThisWeek + delta,
+                           totalTimeSpent=user.totalTimeSpent + delta,
+                           clockedIn=0)
+        # Logged as if they left that long after they came in, so it can be replayed
+        store.events.log(user.id, 'out', delta, user.timeClockedInAt + delta)
+
+        api_call("reactions.add", channel=command['channel'], 
             name='thumbsup', timestamp=command['ts'])
 
-        print(str(datetime.datetime.now()) + ": " + str(row[4]) + ' clocked out with !outtime')
+        log.info("clocked out with !outtime user=%s name=%s", user.id, user.realName)
     else:
-        slack_client.api_call("chat.postMessage", channel=command['channel'],
+        api_call("chat.postMessage", channel=command['channel'],
                 text="You are already clocked out!", as_user=True)
 
 def add_user(command):
-    currentRow = c.execute('''SELECT * FROM users WHERE id=?''', (command['user'],))
-    row = currentRow.fetchone()
-
-    if row:
-        slack_client.api_call("chat.postMessage", channel=command['channel'],
+    if store.get(command['user']):
+        api_call("chat.postMessage", channel=command['channel'],
                 text="You are already in the database, if you're having issues, try *!active*.", as_user=True)
+        return
+    user = directory.cached(command['user'])
+    if user:
+        finish_adding(command, user)
     else:
-        users = slack_client.api_call("users.list")
-        for user in users['members']:
-            if user['id'] == command['user']:
-                c.execute('INSERT INTO users VALUES (?, ?, 0, 0.0, 0.0, 0, 0.0, 0.0, 0.0, 0)', (command['user'], user['name']))
-                break
-        slack_client.api_call("reactions.add", channel=command['channel'], 
-            name='thumbsup', timestamp=command['ts'])
-        # Mark them active automatically
-        active(command)
+        # Slack gets asked on the API threads, so nobody else's commands wait on the answer
+        lookup = asyncio.ensure_future(add_looked_up(command, api_call("users.info", user=command['user'])))
+        lookups.add(lookup)
+        lookup.add_done_callback(lookups.discard)
+
+async def add_looked_up(command, response):
+    # Finishes !addme once Slack has said who they are
+    try:
+        finish_adding(command, directory.found(await asyncio.wrap_future(response)))
+        commit()
+    except Exception:
+        COMMAND_ERRORS.inc(command='!addme')
+        log.exception("adding a user failed user=%s", command['user'])
+
+def finish_adding(command, user):
+    # They could have been added by another !addme while we waited on Slack
+    if user and not store.get(command['user']):
+        store.add(command['user'], user['name'])
+    api_call("reactions.add", channel=command['channel'], 
+        name='thumbsup', timestamp=command['ts'])
+    # Mark them active automatically
+    active(command)
+
+def board_text(board, title, suffix, closing, empty):
+    # The message for a leaderboard. It only gets built again once the board changes
+    if board.text is None:
+        if board.top:
+            board.text = title + "".join("*" + store.get(userId).realName + "*: " + toTime(value) + suffix
+                                         for value, userId in board.top) + closing
+        else:
+            board.text = empty
+    return board.text
 
 def get_standings(command):
     # Show current standings
-    text = "*Here are the current latest people this week:*\n"
-    origText = text
-    for user in c.execute('''SELECT realName, timeLateThisWeek FROM users WHERE active=1 ORDER BY timeLateThisWeek DESC LIMIT 5'''):
-        if user[1] > 0:
-            text += "*"+user[0]+"*: " + toTime(user[1]) + " late\n"
-
-    if text == origText:
-        text = "Nobody has been late this week. At least not _yet_"
-    else:
-        text+= "Better luck next time!"
+    text = board_text(store.boards['timeLateThisWeek'], "*Here are the current latest people this week:*\n", " late\n",
+            "Better luck next time!", "Nobody has been late this week. At least not _yet_")
 
-    slack_client.api_call("chat.postMessage", channel=command["channel"], as_user=True,
+    api_call("chat.postMessage", channel=command["channel"], as_user=True,
             text=text, linkNames=False)
 
-def report(command):
-    rows = c.execute('''SELECT realName, timeLateThisWeek, timeSpentThisWeek FROM users WHERE active=1''')
-    # Write the current status to a csv
-    with open(str(datetime.date.today()) + '-timesheet.csv', 'w') as f:
-        csv_writer = csv.writer(f)
-        csv_writer.writerow([i[0] for i in c.description])
-        for row in rows:
-            csv_writer.writerow([row[0], toTime(row[1]), toTime(row[2])])
+def get_work_standings(command):
+    # Show who has put in the most time
+    text = board_text(store.boards['timeSpentThisWeek'], "*Here are the hardest workers this week:*\n", " worked\n",
+            "Keep it up!", "Nobody has done any work this week. At least not _yet_")
 
-    # Make it send to the leader channel
-    slack_client.api_call('files.upload', as_user=True, channels=command['channel'], filename=str(datetime.date.today()) + '-timesheet.csv', file=open(str(datetime.date.today()) + '-timesheet.csv', 'rb'))
+    api_call("chat.postMessage", channel=command["channel"], as_user=True,
+            text=text, linkNames=False)
 
-def reset(command):
-    report(command)
+def report_args(words):
+    '''
+    Picks the timesheet columns out of something like !report semester late.
+    Leaving out week/semester means the week, leaving out late/worked means
+    both, and numbers gives plain seconds instead of hours and minutes. '''
+
+    periods = [word for word in words if word in ('week', 'semester')] or ['week']
+    kinds = [word for word in words if word in ('late', 'worked')] or ['late', 'worked']
+    if any(word not in ('week', 'semester', 'late', 'worked', 'numbers') for word in words):
+        raise ValueError(words)
+    columns = [column for key, column in REPORT_COLUMNS.items() if key[0] in periods and key[1] in kinds]
+    return columns, 'numbers' in words
+
+def write_report(f, columns, numbers=False):
+    # Streams the timesheet for everybody active into f as a csv, one row at a time
+    csv_writer = csv.writer(f)
+    csv_writer.writerow(['Name'] + [label for name, label in columns])
+    rows = c.execute('SELECT realName, ' + ', '.join(name for name, label in columns) +
+                     ' FROM users WHERE active=1 ORDER BY realName')
+    for row in rows:
+        if numbers:
+            csv_writer.writerow([row[0]] + ['%.0f' % value for value in row[1:]])
+        else:
+            csv_writer.writerow([row[0]] + [toTime(value) for value in row[1:]])
+
+def report(command):
+    columns, numbers = command.get('args') or report_args([])
+    send_timesheet(command['channel'], timesheet(columns, numbers))
+
+def timesheet(columns, numbers):
+    # Writes the current status to a csv that only touches the disk if it gets big
+    f = tempfile.SpooledTemporaryFile(max_size=REPORT_MEMORY_LIMIT)
+    write_report(codecs.getwriter('utf-8')(f), columns, numbers)
+    f.seek(0)
+    return f
+
+def send_timesheet(channel, f):
+    # Uploads a timesheet from timesheet() and closes it once it's gone
+    upload = api_call('files.upload', as_user=True, channels=channel,
+            filename=str(datetime.date.today()) + '-timesheet.csv', file=f)
+    upload.add_done_callback(lambda future: f.close())
 
-    # Resets the time for the week
-    c.execute('''UPDATE users SET timeLateThisWeek=0.0, clockedIn=0, timeSpentThisWeek=0.0''')
-    slack_client.api_call("chat.postMessage", channel=command['channel'], 
+def reset(command):
+    rollover(command['channel'], command['user'])
+    api_call("chat.postMessage", channel=command['channel'], 
             text="Standings reset!", as_user=True)
-    with open('reset.log', 'a+') as f:
-        f.write(str(datetime.datetime.now()) + ': ' + command['user'] + ' reset timebot.\n')
+
+def rollover(channel, userId):
+    '''
+    Ends the week. Everybody's week is saved to the weeks table and
+    zeroed, all in one transaction, and then the timesheet from before it
+    goes to channel (if there is one). If it fails nothing gets sent, so
+    trying again doesn't send the timesheet twice. userId is whoever
+    ended it. '''
+
+    # Anything already done goes in first, so only the rollover is undone if it fails
+    commit()
+    sheet = timesheet(*report_args([])) if channel else None
+    try:
+        store.end_week(userId)
+        commit()
+    except:
+        conn.rollback()
+        team().reload()
+        if sheet:
+            sheet.close()
+        raise
+    if sheet:
+        send_timesheet(channel, sheet)
+    log.info("rolled the week over by=%s", userId)
 
 
 def active(command):
     # Users mark themselves active
-    if not c.execute('''UPDATE users SET active=1 WHERE id=?''', (command['user'],)) :
-        slack_client.api_call("chat.postMessage", channel=command['channel'],
+    user = store.get(command['user'])
+    if not user:
+        api_call("chat.postMessage", channel=command['channel'],
                 text="You are not in the database. Talk to an administrator.", as_user=True)
         return
+    store.update(user, active=1)
     
-    slack_client.api_call("reactions.add", channel=command['channel'], 
+    api_call("reactions.add", channel=command['channel'], 
             name='white_check_mark', timestamp=command['ts'])
-    print( command['user'] + " marked themselves active")
+    log.info("marked active user=%s", command['user'])
 
 def inactive(command):
     # Users mark themselves inactive
-    if not c.execute('''UPDATE users SET active=0 WHERE id=?''', (command['user'],)) :
-        slack_client.api_call("chat.postMessage", channel=command['channel'],
+    user = store.get(command['user'])
+    if not user:
+        api_call("chat.postMessage", channel=command['channel'],
                 text="You are not in the database. Talk to an administrator.", as_user=True)
         return
-    slack_client.api_call("reactions.add", channel=command['channel'], 
+    store.update(user, active=0)
+    api_call("reactions.add", channel=command['channel'], 
             name='white_check_mark', timestamp=command['ts'])
-    print( command['user'] + " marked themselves inactive")
+    log.info("marked inactive user=%s", command['user'])
 
 def status(command):
     # Prints out their current late time
-    response = c.execute('''SELECT id, timeLateThisWeek, timeSpentThisWeek FROM users WHERE id=?''', (command['user'],)).fetchone()
-    if not response:
-        slack_client.api_call("chat.postMessage", channel=command['channel'],
+    user = store.get(command['user'])
+    if not user:
+        api_call("chat.postMessage", channel=command['channel'],
                 text="You are not in the database. Talk to an administrator.", as_user=True)
         return
 
-    if response[1] > 0:
-        text = "You have been " + toTime(response[1]) + " late this week. "
+    if user.timeLateThisWeek > 0:
+        text = "You have been " + toTime(user.timeLateThisWeek) + " late this week. "
     else:
         text = "You have not been late yet this week."
 
     text += " "
 
-    if response[2] > 0:
-        text += "You have worked for " + toTime(response[2]) + " this week. "
+    if user.timeSpentThisWeek > 0:
+        text += "You have worked for " + toTime(user.timeSpentThisWeek) + " this week. "
     else:
         text += "You have not done any work yet this week. "
-    slack_client.api_call("chat.postMessage", channel=command["channel"], as_user=True,
+    api_call("chat.postMessage", channel=command["channel"], as_user=True,
                 text=text)
 
+def total_time(command, column, text):
+    # Tells the channel the running total of a column over everybody active
+    api_call("chat.postMessage", channel=command["channel"], as_user=True,
+            text=text + toTime(store.totals[column]) + ".")
+
+def late_week(command):
+    total_time(command, 'timeLateThisWeek', "The total time that we've been late this week is ")
+
+def late_semester(command):
+    total_time(command, 'totalTimeLate', "The total time that we've been late this semester is ")
+
+def work_week(command):
+    total_time(command, 'timeSpentThisWeek', "The total time that we've been hard at work this week is ")
+
+def work_semester(command):
+    total_time(command, 'totalTimeSpent', "The total time that we've been hard at work this semester is ")
+
+def attendance(command):
+    if command.get('args'):
+        attendance_on(command, command['args'])
+        return
+
+    # Return the list of people that aren't here
+    today = datetime.date.today().toordinal()
+    lines = ["These people haven't clocked in yet today:\n"]
+    for user in sorted(store.absent(), key=lambda user: user.checkInDate, reverse=True):
+        daysAgo = today - user.checkInDate
+        lines.append("*" + user.realName + "*: " + str(daysAgo) + (" day ago\n" if daysAgo == 1 else " days ago\n"))
+
+    api_call("chat.postMessage", channel=command["channel"], as_user=True,
+            text="".join(lines))
+
+def attendance_on(command, day):
+    # Who out of everybody active came in on an earlier day
+    here = store.events.clocked_in_on(day)
+    present = sorted(user.realName for user in store.active_users() if user.id in here)
+    missing = sorted(user.realName for user in store.active_users() if user.id not in here)
+
+    text = "On " + str(day) + " these people clocked in: " + (", ".join(present) or "nobody") + "\n"
+    text += "These people didn't: " + (", ".join(missing) or "nobody")
+    api_call("chat.postMessage", channel=command["channel"], as_user=True,
+            text=text)
+
+def date_arg(words):
+    # !attendance 2017-09-14, or nothing for today
+    if not words:
+        return None
+    return datetime.datetime.strptime(words[0], '%Y-%m-%d').date()
+
+def history(command):
+    # What somebody did each day for the last few days
+    user = store.get(command['user'])
+    if not user:
+        api_call("chat.postMessage", channel=command['channel'],
+                text="You are not in the database. Talk to an administrator.", as_user=True)
+        return
+    days = command.get('args') or HISTORY_DAYS
+    api_call("chat.postMessage", channel=command["channel"], as_user=True,
+            text=store.analytics.cached(user.id, ('history', days), lambda: render_history(user, days)))
+
+def render_history(user, days):
+    today = datetime.date.today().toordinal()
+    rows = dict((row[0], row[1:]) for row in store.analytics.days(user.id, today - days + 1, today))
+    lines = ["Your last " + str(days) + " days:"]
+    for ordinal in range(today - days + 1, today + 1):
+        day = datetime.date.fromordinal(ordinal)
+        label = "*" + day.strftime('%a %Y-%m-%d') + "*: "
+        if ordinal in rows:
+            late, spent, clockIns = rows[ordinal]
+            lines.append(label + ("late " + toTime(late) if late > 0 else "on time") + ", worked " + toTime(spent))
+        elif schedule.start(day, user.id) is not None and ordinal != today:
+            lines.append(label + "didn't clock in")
+    return "\n".join(lines)
+
+def trend(command):
+    # How somebody's weeks (or months) have been going
+    user = store.get(command['user'])
+    if not user:
+        api_call("chat.postMessage", channel=command['channel'],
+                text="You are not in the database. Talk to an administrator.", as_user=True)
+        return
+    period, count = command.get('args') or ('weeks', TREND_WEEKS)
+    render = render_trend_months if period == 'months' else render_trend
+    api_call("chat.postMessage", channel=command["channel"], as_user=True,
+            text=store.analytics.cached(user.id, ('trend', period, count), lambda: render(user, count)))
+
+def render_trend(user, weeks):
+    today = datetime.date.today().toordinal()
+    thisWeek = week_of(today)
+    rows = dict((row[0], row[1:]) for row in store.analytics.weeks(user.id, thisWeek - 7 * (weeks - 1), today))
+    lines = ["Your last " + str(weeks) + " weeks (each \u2588 is an hour worked):"]
+    for week in range(thisWeek - 7 * (weeks - 1), thisWeek + 1, 7):
+        late, spent, clockIns = rows.get(week, (0.0, 0.0, 0))
+        lines.append("*" + str(datetime.date.fromordinal(week)) + "*: " + "\u2588" * min(40, int(round(spent / 3600))) +
+                     " worked " + toTime(spent) + ", late " + toTime(late))
+    return "\n".join(lines)
+
+def render_trend_months(user, months):
+    today = datetime.date.today().toordinal()
+    firsts = [month_of(today)]
+    while len(firsts) < months:
+        firsts.insert(0, month_of(firsts[0] - 1))
+    rows = dict((row[0], row[1:]) for row in store.analytics.months(user.id, firsts[0], today))
+    lines = ["Your last " + str(months) + " months (each \u2588 is ten hours worked):"]
+    for month in firsts:
+        late, spent, clockIns = rows.get(month, (0.0, 0.0, 0))
+        lines.append("*" + datetime.date.fromordinal(month).strftime('%b %Y') + "*: " + "\u2588" * min(40, int(round(spent / 36000))) +
+                     " worked " + toTime(spent) + ", late " + toTime(late))
+    lines.append("*This semester*: worked " + toTime(user.totalTimeSpent) + ", late " + toTime(user.totalTimeLate))
+    return "\n".join(lines)
+
+def streak(command):
+    # How many workdays in a row somebody has been on time
+    user = store.get(command['user'])
+    if not user:
+        api_call("chat.postMessage", channel=command['channel'],
+                text="You are not in the database. Talk to an administrator.", as_user=True)
+        return
+    api_call("chat.postMessage", channel=command["channel"], as_user=True,
+            text=store.analytics.cached(user.id, ('streak',), lambda: render_streak(user)))
+
+def render_streak(user):
+    workday = lambda ordinal: schedule.start(datetime.date.fromordinal(ordinal), user.id) is not None
+    current, longest = store.analytics.streak(user.id, datetime.date.today().toordinal(), workday)
+    if current:
+        text = "You've been on time " + str(current) + (" workday" if current == 1 else " workdays") + " in a row."
+    else:
+        text = "You don't have a streak going. Come in on time tomorrow to start one!"
+    return text + " Your best is " + str(longest) + "."
+
+def days_arg(words):
+    # !history 14, or nothing for HISTORY_DAYS
+    if not words:
+        return None
+    days = int(words[0])
+    if not 0 < days <= MAX_HISTORY_DAYS:
+        raise ValueError(days)
+    return days
+
+def trend_args(words):
+    # !trend 12 or !trend months 6, or nothing for TREND_WEEKS
+    if not words:
+        return None
+    if words[0] == 'months':
+        months = int(words[1]) if len(words) > 1 else TREND_MONTHS
+        if not 0 < months <= MAX_TREND_MONTHS:
+            raise ValueError(months)
+        return 'months', months
+    weeks = int(words[0])
+    if not 0 < weeks <= MAX_TREND_WEEKS:
+        raise ValueError(weeks)
+    return 'weeks', weeks
+
+def check_totals(command):
+    # Makes sure the running totals still match the database
+    wrong = store.check_totals()
+    if wrong:
+        text = "These totals don't match the database: " + ", ".join(wrong) + ". Recounted them."
+        store.recount()
+    else:
+        text = "All the totals match the database."
+    api_call("chat.postMessage", channel=command["channel"], as_user=True,
+            text=text)
+
+def usage(command):
+    api_call("chat.postMessage", channel=command["channel"], as_user=True,
+            text=usage_for(command['channel'][0] == 'D'))
+
+def minutes_arg(words):
+    # !intime 5, up to a day's worth
+    minutes = int(words[0])
+    if not 0 <= minutes <= 1440:
+        raise ValueError("minutes out of range: %d" % minutes)
+    return minutes
+
+def hours_arg(words):
+    # !outtime 2.5, more than nothing and no more than a day
+    hours = float(words[0])
+    if not math.isfinite(hours) or not 0 < hours <= 24:
+        raise ValueError("hours out of range: %r" % hours)
+    return hours
+
+# Everything the bot knows how to do, keyed by the first word of the message.
+# Private commands only work in a DM. Commands without usage text are left out
+# of the usage statements. parse turns the rest of the words into command['args'].
+Command = collections.namedtuple('Command', ['handler', 'private', 'usage', 'parse'])
+
+COMMANDS = {
+    '!in': Command(clock_in, True, "*!in*: Clock in", None),
+    '!intime': Command(in_late, True, "*!intime number*: Clock in being _number_ minutes late. (For when you forget to clock in). Ex: !intime 5", minutes_arg),
+    '!out': Command(clock_out, True, "*!out*: Clock out", None),
+    '!outtime': Command(out_late, True, "*!outtime number*: Clock out having worked _number_ hours. Ex: !outtime 2 (worked 2 hours)", hours_arg),
+    '!active': Command(active, True, "*!active*: Mark yourself active", None),
+    '!inactive': Command(inactive, True, "*!inactive*: Mark yourself inactive", None),
+    '!status': Command(status, True, "*!status*: See your current late time this week", None),
+    '!addme': Command(add_user, True, None, None),
+    '!history': Command(history, True, "*!history [days]*: See when you came in and how long you worked each day. Ex: !history 14", days_arg),
+    '!trend': Command(trend, True, "*!trend [weeks | months [months]]*: See how much you've worked and been late each week, or each month and this semester. Ex: !trend 12, !trend months 6", trend_args),
+    '!streak': Command(streak, True, "*!streak*: See how many workdays in a row you've been on time", None),
+    '!report': Command(report, True, "*!report [week|semester] [late|worked] [numbers]*: Get a timesheet for everybody active. Ex: !report semester worked", report_args),
+    '!!reset': Command(reset, True, None, None),
+    '!!checktotals': Command(check_totals, True, None, None),
+    '!standings': Command(get_standings, False, "*!standings*: View current standings for the week", None),
+    '!workstandings': Command(get_work_standings, False, "*!workstandings*: See who has worked the most this week", None),
+    '!attendance': Command(attendance, False, "*!attendance [date]*: See who hasn't clocked in today, or who came in on a date. Ex: !attendance 2017-09-14", date_arg),
+    '!workweek': Command(work_week, False, "*!workweek*: See the cumulative time that people have worked this week", None),
+    '!worksemester': Command(work_semester, False, "*!worksemester*: See the cumulative time that people have worked this semester", None),
+    '!lateweek': Command(late_week, False, "*!lateweek*: See the cumulative time that people have been late this week", None),
+    '!latesemester': Command(late_semester, False, "*!latesemester*: See the cumulative time that people have been late this semester", None),
+    '!usage': Command(usage, False, "*!usage*: This usage statement", None),
+}
+
 def parse_slack_output(slack_rtm_output):
     """
     The Slack Real Time Messaging API is an events firehose.
-    this parsing function returns None unless a message is
-    directed at the Bot, based on its ID.
+    this parsing function returns every message in the batch that is
+    a command directed at the Bot, in the order they arrived.
+    """
+    commands = []
+    botId = team().botId
+    for output in slack_rtm_output or []:
+        if output and 'text' in output and output['text'].startswith('!') and output.get('user') != botId:
+            commands.append({'text': output['text'].strip().lower(),
+                    'channel': output['channel'], 
+                    'user': output['user'],
+                    'ts': output['ts']})
+    return commands
+
+def run_command(command):
+    # Handles one command without letting it take the whole bot down, unless we already handled it
+    global current_command
+    if not store.processed.add(command['channel'], command['ts']):
+        DUPLICATES.inc()
+        log.info("skipped a message we already handled channel=%s ts=%s", command['channel'], command['ts'])
+        return
+    current_command = command_name(command)
+    COMMANDS_HANDLED.inc(command=current_command)
+    try:
+        handle_command(command)
+    except Exception:
+        COMMAND_ERRORS.inc(command=current_command)
+        api_call("chat.postMessage", channel=command['channel'],
+            text="Whoa! You almost killed me! Try doing *!active*. If that doesn't work, talk to an administrator.", as_user=True)
+        log.exception("command failed user=%s text=%r", command['user'], command['text'])
+    finally:
+        current_command = None
+
+def set_health(state):
+    workspace = team()
+    if state != workspace.health:
+        log.info("connection workspace=%s state=%s was=%s", workspace.name, state, workspace.health)
+    workspace.health = state
+    for name in HEALTH_STATES:
+        HEALTH.set(1 if name == state else 0, workspace=workspace.name, state=name)
+
+def rtm_connected():
+    # Whether the RTM connection has been made yet
+    server = slack_client.server
+    return server is not None and server.connected
+
+def rtm_socket():
+    # The raw socket under the RTM websocket, so asyncio can tell us when it has data
+    return slack_client.server.websocket.sock
+
+class Inbox(object):
+    '''
+    Where commands read off the RTM stream go: straight onto the queue,
+    except while we're catching up. Then a DM's live commands are held
+    until its history has been read, and go on the queue together with
+    whatever we missed in it, oldest first, so one person's commands are
+    always handled in the order they sent them. A DM with something held
+    gets its history read next. '''
+
+    def __init__(self, queue):
+        self.queue = queue
+        # Held commands by DM, or None when we aren't catching up
+        self.held = None
+        # Whether we know which DMs there are yet. Until then every DM's commands are held.
+        self.listed = False
+        # DMs whose history hasn't been read yet, and the ones of those somebody is waiting on
+        self.unread = collections.OrderedDict()
+        self.waiting = collections.deque()
+        # How many DM lists or histories Slack wouldn't give us this time around
+        self.gaps = 0
+
+    def start(self):
+        self.held = {}
+        self.listed = False
+        self.unread.clear()
+        self.waiting.clear()
+        self.gaps = 0
+
+    def add_dms(self, channels):
+        # The DMs to read the history of, with the ones that already have something held first
+        for channel in channels:
+            self.unread[channel] = True
+        self.listed = True
+        self.waiting.extend(channel for channel in self.held if channel in self.unread)
+
+    async def put(self, command):
+        channel = command['channel']
+        if self.held is None or channel[0] != 'D':
+            await self.queue.put(command)
+        elif channel in self.held or channel in self.unread or not self.listed:
+            if channel in self.unread and channel not in self.held:
+                self.waiting.append(channel)
+            self.held.setdefault(channel, []).append(command)
+        else:
+            await self.queue.put(command)
+
+    def next_unread(self):
+        # The next DM to read the history of, or None if that's all of them. Its commands are held until it's released.
+        channel = None
+        while self.waiting and channel is None:
+            if self.unread.pop(self.waiting[0], None):
+                channel = self.waiting[0]
+            self.waiting.popleft()
+        if channel is None and self.unread:
+            channel = self.unread.popitem(last=False)[0]
+        if channel is not None:
+            self.held.setdefault(channel, [])
+        return channel
+
+    async def release(self, channel, missed):
+        # Queues what we missed in channel with whatever was held for it, then lets it through
+        seen = set()
+        commands = []
+        for command in sorted(missed + self.held.get(channel, []), key=lambda command: float(command['ts'])):
+            if command['ts'] not in seen:
+                seen.add(command['ts'])
+                commands.append(command)
+        self.held[channel] = []
+        while commands:
+            for command in commands:
+                await self.queue.put(command)
+            # Anything read while those went on the queue was sent after them
+            commands, self.held[channel] = self.held[channel], []
+        del self.held[channel]
+
+    async def finish(self):
+        # Lets everything through again, starting with anything still held for a DM we didn't know about
+        for channel in list(self.held):
+            await self.release(channel, [])
+        self.held = None
+
+    def stop(self):
+        # Gives up on catching up. Anything held for a DM is still in its history for next time.
+        self.held = None
+
+async def read_events(queue):
+    """
+    Reads the firehose as soon as the websocket has data and puts every
+    command on the queue, forever. If the connection drops or goes quiet
+    we reconnect and catch up on whatever was sent to us in the meantime,
+    and the same goes for whatever came in while the bot wasn't running.
+    The stream is still read while we catch up, so Slack never waits on
+    us however long the history takes. Anything going wrong with reading,
+    pinging or catching up counts as losing the connection.
+    """
+    inbox = Inbox(queue)
+    if not rtm_connected():
+        # Starting up, and the first connection backs off and tries again like any other
+        await reconnect()
+    while True:
+        reading = asyncio.ensure_future(read_connection(inbox))
+        catching = asyncio.ensure_future(catch_up(inbox))
+        try:
+            await asyncio.wait([reading, catching], return_when=asyncio.FIRST_COMPLETED)
+            if not reading.done():
+                # Caught up, so it's just the stream from here on, unless catching up went wrong
+                catching.result()
+                await reading
+            error = reading.result()
+        except Exception as e:
+            log.exception("reading from Slack failed workspace=%s", team().name)
+            error = repr(e)
+        finally:
+            reading.cancel()
+            catching.cancel()
+            # Let them finish up with this connection before there's a new one
+            await asyncio.wait([reading, catching])
+            inbox.stop()
+        # We write what time it happened and what happened
+        with open('crash.log', 'a+') as f:
+            f.write(str(datetime.datetime.now()) + ': ' + team().name + ': ' + error + '\n')
+        log.warning("lost the connection to Slack workspace=%s error=%s", team().name, error)
+
+        await reconnect()
+
+async def read_connection(inbox):
+    # Reads one connection until it's gone, then says what happened to it
+    loop = asyncio.get_event_loop()
+    readable = asyncio.Event()
+    sock = rtm_socket()
+    loop.add_reader(sock, readable.set)
+    heard = pinged = loop.time()
+    try:
+        while True:
+            # A timer rather than wait_for, which can swallow a cancel that comes in just as the socket becomes readable
+            timer = loop.call_later(RTM_IDLE_TIMEOUT, readable.set)
+            try:
+                await readable.wait()
+            finally:
+                timer.cancel()
+            readable.clear()
+
+            try:
+                # One read can leave more messages behind it, so keep going until it runs dry
+                events = slack_client.rtm_read()
+                while events:
+                    heard = loop.time()
+                    for command in parse_slack_output(events):
+                        await inbox.put(command)
+                    events = slack_client.rtm_read()
+            # Sometimes the socket closes
+            except (TimeoutError, websocket._exceptions.WebSocketConnectionClosedException) as e:
+                return str(type(e))
+
+            # Make sure a quiet connection is really still there
+            now = loop.time()
+            if now - heard > 2 * PING_INTERVAL:
+                return "no answer to ping"
+            if now - heard > PING_INTERVAL and now - pinged > PING_INTERVAL:
+                slack_client.server.ping()
+                pinged = now
+    finally:
+        loop.remove_reader(sock)
+
+async def reconnect():
+    # Keeps trying to reconnect, backing off a random amount more every time it fails
+    loop = asyncio.get_event_loop()
+    set_health('reconnecting')
+    tries = 0
+    while True:
+        try:
+            connected = await loop.run_in_executor(None, slack_client.rtm_connect)
+        except Exception:
+            log.exception("reconnecting raised workspace=%s", team().name)
+            connected = False
+        if connected:
+            RECONNECTS.inc(result='ok')
+            log.warning("reconnected tries=%d", tries + 1)
+            return
+        RECONNECTS.inc(result='failed')
+        delay = random.uniform(0, min(RECONNECT_MAX, RECONNECT_BASE * 2 ** tries))
+        tries += 1
+        log.error("failed to reconnect tries=%d retry_in=%.1f", tries, delay)
+        await asyncio.sleep(delay)
+
+async def catch_up(inbox):
+    """
+    Reads every DM's history from a little before where the last catch-up
+    got to and queues any commands in it we haven't handled yet, in order
+    with whatever came in live meanwhile (see Inbox). Up to
+    CATCH_UP_WORKERS histories are read at once. Once everything it found
+    has been handled, the next catch-up starts from when this one did, so
+    one that gets cut off is done over rather than skipped.
+    """
+    start = time.time()
+    inbox.start()
+    processed = store.processed
+    if processed.caughtUp is None:
+        # Never caught up before, so there's nothing to catch up on
+        await inbox.finish()
+    else:
+        set_health('catching up')
+        # No further back than the messages we still remember handling, or we couldn't tell which we'd missed
+        oldest = str(max(float(processed.caughtUp), processed.horizon() or 0) - CATCH_UP_MARGIN)
+        await read_dms(inbox, oldest)
+    set_health('connected')
+    if inbox.gaps:
+        log.warning("couldn't read every DM, the next catch-up starts from the same place gaps=%d", inbox.gaps)
+        return
+    await inbox.queue.join()
+    store.processed.catch_up_to('%.6f' % start)
+    commit()
+
+async def read_dms(inbox, oldest):
+    # Queues the commands we missed in every DM since oldest, in order with the live ones
+    kwargs = {'types': 'im', 'limit': CATCH_UP_PAGE_SIZE}
+    channels = []
+    while True:
+        response = await asyncio.wrap_future(api_call('conversations.list', **kwargs))
+        if not response.get('ok'):
+            log.error("couldn't list DMs to catch up error=%s", response.get('error'))
+            inbox.gaps += 1
+            break
+        channels.extend(channel['id'] for channel in response['channels'])
+        kwargs['cursor'] = response.get('response_metadata', {}).get('next_cursor')
+        if not kwargs['cursor']:
+            break
+    inbox.add_dms(channels)
+
+    caughtUp = await asyncio.gather(*(read_histories(inbox, oldest) for worker in range(CATCH_UP_WORKERS)))
+    await inbox.finish()
+    log.info("caught up channels=%d commands=%d", len(channels), sum(caughtUp))
+
+async def read_histories(inbox, oldest):
+    # Reads DM histories one after another until there are none left, and returns how many commands it missed
+    count = 0
+    channel = inbox.next_unread()
+    while channel is not None:
+        history = await channel_history(channel, oldest)
+        if history is None:
+            inbox.gaps += 1
+            history = []
+        missed = [command for command in parse_slack_output(history)
+                  if (command['channel'], command['ts']) not in store.processed]
+        CAUGHT_UP.inc(len(missed))
+        count += len(missed)
+        await inbox.release(channel, missed)
+        channel = inbox.next_unread()
+    return count
+
+async def channel_history(channel, oldest):
+    # Every message in channel newer than oldest, each with its channel filled in, or None if Slack wouldn't give us all of them
+    messages = []
+    kwargs = {'channel': channel, 'oldest': oldest, 'limit': CATCH_UP_PAGE_SIZE}
+    while True:
+        response = await asyncio.wrap_future(api_call('conversations.history', **kwargs))
+        if not response.get('ok'):
+            log.error("couldn't read DM history channel=%s error=%s", channel, response.get('error'))
+            return None
+        for message in response['messages']:
+            message['channel'] = channel
+            messages.append(message)
+        kwargs['cursor'] = response.get('response_metadata', {}).get('next_cursor')
+        if not response.get('has_more') or not kwargs['cursor']:
+            return messages
+
+def sweep_sessions():
+    '''
+    Clocks out everybody who has been clocked in for more than
+    MAX_SESSION_HOURS, since they must have forgotten !out, and lets
+    them know. Returns how many there were. '''
+
+    workspace = team()
+    if workspace.conn is None and workspace.clockedIn == 0:
+        # Nobody was clocked in when the shard was closed, so there's no need to open it
+        return 0
+    users = store.close_sessions(time.time() - MAX_SESSION_HOURS * 3600)
+    commit()
+    for user in users:
+        api_call("chat.postMessage", channel=user.id, as_user=True,
+                text="You were clocked in for more than " + str(MAX_SESSION_HOURS) + " hours, so I clocked you out. "
+                     "You didn't get any time for it. If you worked, talk to an administrator.")
+        log.info("clocked out automatically user=%s name=%s", user.id, user.realName)
+    return len(users)
+
+async def run_sweeps():
+    # Looks for forgotten clock-outs every SWEEP_INTERVAL seconds
+    while True:
+        try:
+            sweep_sessions()
+        except Exception:
+            log.exception("couldn't clock out forgotten sessions")
+        await asyncio.sleep(SWEEP_INTERVAL)
+
+async def run_rollovers():
+    '''
+    Rolls the week over whenever the schedule says to, without anybody
+    having to send !!reset. If the bot was down when it should have
+    happened, it happens as soon as the bot is back. '''
+
+    if schedule.rollover is None:
+        return
+    since = store.events.last_reset() or time.time()
+    while True:
+        now = time.time()
+        if since < schedule.last_rollover(now):
+            leaders = team().leader_channel_id
+            if leaders is None:
+                log.error("no leaders' channel to send the timesheet to, rolling over anyway")
+            try:
+                rollover(leaders, 'timebot')
+            except Exception:
+                # Leave since alone so it's tried again, rather than folding this week into the next
+                log.exception("couldn't roll the week over, trying again in %d seconds", ROLLOVER_RETRY)
+                await asyncio.sleep(ROLLOVER_RETRY)
+                continue
+            if leaders:
+                api_call("chat.postMessage", channel=leaders, as_user=True,
+                        text="That's the week! Here's the timesheet, and the standings are reset.")
+            since = now
+        # Check back at least every ROLLOVER_CHECK seconds in case the clock jumps
+        await asyncio.sleep(max(0, min(ROLLOVER_CHECK, schedule.next_rollover(now) - time.time())))
+
+def commit():
+    # Writes out whatever the last commands changed, if anything. A closed shard was committed when it was closed.
+    if team().conn is None:
+        return
+    store.flush()
+    if conn.in_transaction:
+        start = time.perf_counter()
+        conn.commit()
+        COMMIT_SECONDS.observe(time.perf_counter() - start)
+
+async def handle_commands(queue):
+    '''
+    Handles commands in the order they came in, forever. Once a command
+    changes something we wait up to COMMIT_DELAY before committing, so
+    the rest of a burst goes into the same transaction. Whatever is
+    already queued gets handled before another workspace gets a turn, so
+    the shard is only opened once for all of it. '''
+
+    loop = asyncio.get_event_loop()
+    commitAt = None
+    while True:
+        timeout = None if commitAt is None else max(0, commitAt - loop.time())
+        if queue.empty():
+            # asyncio.wait rather than wait_for, which can swallow a cancel that comes in just as a command does
+            getter = asyncio.ensure_future(queue.get())
+            try:
+                done, _ = await asyncio.wait([getter], timeout=timeout)
+            finally:
+                getter.cancel()
+            if not done:
+                commit()
+                commitAt = None
+                continue
+            command = getter.result()
+        else:
+            command = queue.get_nowait()
+
+        run_command(command)
+        queue.task_done()
+        store.flush()
+        if commitAt is None and conn.in_transaction:
+            commitAt = loop.time() + COMMIT_DELAY
+        if commitAt is not None and loop.time() >= commitAt:
+            commit()
+            commitAt = None
+
+async def serve(workspaces=None):
     """
-    output_list = slack_rtm_output
-    if output_list and len(output_list) > 0:
-        for output in output_list:
-            if output and 'text' in output and output['text'].startswith('!') and output['user'] != BOT_ID:
-                return {'text': output['text'].strip().lower(),
-                        'channel': output['channel'], 
-                        'user': output['user'],
-                        'ts': output['ts']}
-    return None
+    Runs the bot for every workspace in workspaces, or just the current
+    one, until it's stopped. They all share the one event loop, each with
+    tasks of its own, so a busy or reconnecting team doesn't hold up the
+    others.
+    """
+    await asyncio.gather(*(supervise(workspace) for workspace in workspaces or [team()]))
+
+async def supervise(workspace):
+    # Keeps one workspace running, starting it again whenever it falls over, so its trouble stays its own
+    while True:
+        try:
+            await serve_workspace(workspace)
+        except Exception:
+            log.exception("workspace stopped workspace=%s restart_in=%.1f", workspace.name, RESTART_DELAY)
+        await asyncio.sleep(RESTART_DELAY)
+
+async def serve_workspace(workspace):
+    """
+    Runs one workspace until it's stopped, or until one of its tasks
+    raises (see supervise()). Reading and handling are separate tasks
+    joined by a bounded queue, and replies go out on the API threads while
+    the next command is handled. The week rolls over, and forgotten
+    clock-outs get swept up, from other tasks in between two commands.
+    """
+    # Only this task and the ones it starts see it, since each task has its own context
+    use_workspace(workspace)
+    queue = asyncio.Queue(maxsize=MAX_QUEUED_COMMANDS)
+    QUEUE_DEPTH.set_function(queue.qsize, workspace=workspace.name)
+    CLOCKED_IN.set_function(workspace.clocked_in, workspace=workspace.name)
+    tasks = [asyncio.ensure_future(read_events(queue)), asyncio.ensure_future(handle_commands(queue)),
+             asyncio.ensure_future(run_rollovers()), asyncio.ensure_future(run_sweeps())]
+    try:
+        # They only stop by raising (or when there's no rollover to do), and then the whole workspace stops
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        for task in done:
+            task.result()
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.wait(tasks)
+        DROPPED_EVENTS.inc(queue.qsize())
+        commit()
+
+def start_workspace(workspace):
+    '''
+    Gets workspace ready to serve: brings its database up to date and in
+    line with Slack and finds its leaders' channel. It connects once it's
+    being served (see read_events), so a team Slack won't let in yet keeps
+    trying instead of being left out. '''
+
+    use_workspace(workspace)
+    # Make sure the database is up to date and knows about everybody
+    initialize_db(workspace.dbName)
+
+    for channel in web.call("groups.list").get('groups', []):
+        if channel['name'] == workspace.leaderChannel:
+            workspace.leader_channel_id = channel['id']
+            break
+    if workspace.leader_channel_id is None:
+        log.error("didn't find the leaders' channel workspace=%s name=%s", workspace.name, workspace.leaderChannel)
+    log.info("ready workspace=%s", workspace.name)
 
 
 if __name__ == "__main__":
-    READ_WEBSOCKET_DELAY = .3 # .3 second delay between reading from firehose
+    parser = argparse.ArgumentParser(description="Keeps track of when the team comes in")
+    parser.add_argument('--backfill', action='store_true', help="Correct everybody's totals from the clock events and exit")
+    parser.add_argument('--metrics-port', type=int, default=METRICS_PORT, help="Where to serve /metrics on localhost, or 0 for nowhere")
+    parser.add_argument('--workspaces', default=WORKSPACES_FILE, help="The workspaces to serve, if there's more than the one in SLACK_BOT_TOKEN")
+    args = parser.parse_args()
 
-    # If the database doesn't exist, you rebuild it
-    if not os.path.isfile("team.db"):
-        initialize_db()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s level=%(levelname)s logger=%(name)s %(message)s')
 
-    # Open up the database
-    conn = sqlite3.connect('team.db')
-    c = conn.cursor()
+    workspaces = connect_workspaces(load_workspaces(args.workspaces, DB_NAME))
 
-    if slack_client.rtm_connect():
-        print("TimeBot connected and running!")
-        for channel in slack_client.api_call("groups.list")['groups']:
-            if channel['name'] == leader_channel:
-                leader_channel_id = channel['id']
-                break
-        if leader_channel_id is None:
-            print("I didn't find the leaders' channel :(")
+    if args.backfill:
+        # This doesn't need Slack at all
+        for workspace in workspaces:
+            use_workspace(workspace)
+            backfill_db(workspace.dbName)
+        raise SystemExit
 
-        try:
-            while True:
-                try:
-                    command = parse_slack_output(slack_client.rtm_read())
-                # Sometimes the socket closes
-                except (TimeoutError, websocket._exceptions.WebSocketConnectionClosedException) as e:
-                    # We write what time it happened and what happened
-                    with open('crash.log', 'a+') as f:
-                        f.write(str(datetime.datetime.now()) + ': ' + str(type(e)) + '\n')
-                    # Then we reconnect
-                    if slack_client.rtm_connect():
-                        print(str(datetime.datetime.now()) + ": RECOVERED FROM A CRASH")
-                        continue
-                    else:
-                        print(str(datetime.datetime.now()) + ": Slack client failed to reconnect")
-                        conn.close()
-                        break
-                if command:
-                    try:
-                        handle_command(command)
-                    except Exception as e:
-                        slack_client.api_call("chat.postMessage", channel=command['channel'],
-                            text="Whoa! You almost killed me! Try doing *!active*. If that doesn't work, talk to an administrator.", as_user=True)
-                        print(str(e))
-                if not command:
-                    time.sleep(READ_WEBSOCKET_DELAY)
-        except KeyboardInterrupt:
-            print()
-            print( "Exiting cleanly")
-            conn.close()
-    else:
-        print("Connection failed. Invalid Slack token or bot ID?")
+    # Held for as long as we run, so a backfill can't write under us, and neither can another copy of the bot
+    locks = [lock_database(workspace.dbName) for workspace in workspaces]
+    if None in locks:
+        log.error("the bot is already running on db=%s", workspaces[locks.index(None)].dbName)
+        raise SystemExit(1)
+
+    if args.metrics_port:
+        metrics.serve(args.metrics_port, health=lambda: all(workspace.health == 'connected' for workspace in workspaces))
+
+    # They start up side by side, each in a context of its own
+    with concurrent.futures.ThreadPoolExecutor(API_WORKERS) as pool:
+        list(pool.map(lambda workspace: contextvars.copy_context().run(start_workspace, workspace), workspaces))
+
+    try:
+        asyncio.run(serve(workspaces))
+    except KeyboardInterrupt:
+        log.info("exiting cleanly")
+    # Let the last replies go out before we leave
+    for workspace in workspaces:
+        workspace.web.wait()
+    shards.close()
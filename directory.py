@@ -0,0 +1,76 @@
+#!/usr/bin/python3
+
+import collections
+import time
+
+# How many members to ask for per page of users.list
+PAGE_SIZE = 200
+
+class UserDirectory(object):
+    '''
+    Slack's user profiles keyed by id, so we don't have to download the
+    whole team just to look up one person. Entries go stale after ttl
+    seconds, and once there are more than size of them the least recently
+    used ones get dropped. Anybody we don't have gets fetched on their own
+    with users.info. '''
+
+    def __init__(self, client, ttl=3600, size=1000):
+        self.client = client
+        self.ttl = ttl
+        self.size = size
+        self.users = collections.OrderedDict()
+
+    def remember(self, user):
+        self.users[user['id']] = (time.monotonic(), user)
+        self.users.move_to_end(user['id'])
+        while len(self.users) > self.size:
+            self.users.popitem(last=False)
+
+    def clear(self):
+        self.users.clear()
+
+    def get(self, userId):
+        # The user's profile, or None if Slack doesn't know who that is
+        return self.cached(userId) or self.found(self.client.api_call("users.info", user=userId))
+
+    def cached(self, userId):
+        # The user's profile if we have it and it isn't stale, without asking Slack
+        entry = self.users.get(userId)
+        if entry and time.monotonic() - entry[0] < self.ttl:
+            self.users.move_to_end(userId)
+            return entry[1]
+        return None
+
+    def found(self, response):
+        # The profile in a users.info response, remembered, or None if Slack doesn't know who that is.
+        # For when the call went out some other way, so nothing had to wait on it.
+        if not response or not response.get('ok'):
+            return None
+        self.remember(response['user'])
+        return response['user']
+
+    def all_users(self):
+        '''
+        Every member of the team, one page of users.list at a time.
+        Everybody we see gets remembered along the way. '''
+
+        kwargs = {'limit': PAGE_SIZE}
+        while True:
+            response = self.client.api_call("users.list", **kwargs)
+            if not response or not response.get('ok'):
+                return
+            for user in response['members']:
+                self.remember(user)
+                yield user
+
+            cursor = response.get('response_metadata', {}).get('next_cursor')
+            if not cursor:
+                return
+            kwargs['cursor'] = cursor
+
+    def find(self, name):
+        # Looks somebody up by their username. This has to go through the whole team
+        for user in self.all_users():
+            if user.get('name') == name:
+                return user
+        return None
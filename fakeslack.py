@@ -0,0 +1,225 @@
+#!/usr/bin/python3
+
+import email.parser
+import http.server
+import itertools
+import json
+import socket
+import threading
+import time
+import types
+import urllib.parse
+
+import websocket
+
+# A stand-in for SlackClient so we can run the bot without a real Slack team.
+# Events go over a local socket just like the RTM websocket, so the bot's
+# event loop wakes up for them the same way, and every Web API call the bot
+# makes is remembered along with when it was made. drop() cuts the connection
+# like an outage would, and messages sent while it's down only end up in the
+# DM history. FakeWebAPI puts the same
+# Web API behind a local HTTP server for testing the real client against.
+
+def make_users(count):
+    # Makes a list of users that looks like what users.list gives back
+    return [{'id': 'U%07d' % i, 'name': 'user' + str(i), 'is_bot': False} for i in range(count)]
+
+class FakeSlackClient(object):
+
+    def __init__(self, users=None, groups=None):
+        self.users = users if users is not None else []
+        self.groups = groups if groups is not None else []
+        self.calls = []
+        # Slack timestamps are unique per channel, so make sure ours are too
+        self.clock = itertools.count(int(time.time() * 1000000))
+        self.server = None
+        self.rtm_socket = None
+        self.buffer = b''
+        # Every message ever sent, by channel
+        self.history = {}
+        self.connected = False
+        # How many rtm_connect() calls fail before one works
+        self.failConnects = 0
+        # One lock for the history and one for the socket, so a send that's
+        # waiting on the bot to read doesn't hold up reading the history
+        self.lock = threading.Lock()
+        self.socketLock = threading.RLock()
+
+    def rtm_connect(self):
+        # The bot reads from one end of the pair and send() writes into the other
+        with self.socketLock:
+            self.close()
+            if self.failConnects:
+                self.failConnects -= 1
+                return False
+            self.rtm_socket, sock = socket.socketpair()
+            sock.setblocking(False)
+            self.server = types.SimpleNamespace(websocket=types.SimpleNamespace(sock=sock), ping=self.ping, connected=True)
+            self.buffer = b''
+            self.connected = True
+            return True
+
+    def close(self):
+        with self.socketLock:
+            if self.server:
+                self.rtm_socket.close()
+                self.server.websocket.sock.close()
+                self.server = None
+            self.connected = False
+
+    def drop(self):
+        # Cuts the connection from Slack's end. The bot finds out the next time it reads.
+        with self.socketLock:
+            self.connected = False
+            self.rtm_socket.close()
+
+    def ping(self):
+        self.push({'type': 'pong'})
+
+    def rtm_read(self):
+        # Everything that has come in since the last read, just like the firehose
+        try:
+            data = self.server.websocket.sock.recv(65536)
+        except BlockingIOError:
+            return []
+        except OSError:
+            data = b''
+        if not data:
+            raise websocket._exceptions.WebSocketConnectionClosedException("Connection is already closed.")
+        self.buffer += data
+        *lines, self.buffer = self.buffer.split(b'\n')
+        return [json.loads(line) for line in lines]
+
+    def push(self, event):
+        # Puts an event on the RTM stream if we're connected
+        with self.socketLock:
+            if self.connected:
+                self.rtm_socket.sendall(json.dumps(event).encode() + b'\n')
+
+    def send(self, text, user, channel=None, at=None):
+        # Sends a message as if user had typed it into a DM with the bot, at the timestamp at if it's given
+        tick = next(self.clock) if at is None else int(at * 1000000)
+        ts = str(tick // 1000000) + '.' + '%06d' % (tick % 1000000)
+        event = {'type': 'message', 'text': text, 'user': user,
+                 'channel': channel or 'D' + user[1:], 'ts': ts}
+        with self.lock:
+            self.history.setdefault(event['channel'], []).append(event)
+        self.push(event)
+        return event
+
+    def api_call(self, method, **kwargs):
+        self.calls.append((method, kwargs, time.perf_counter()))
+        if method == 'users.list':
+            # Pages work like Slack's, the cursor is just where the next page starts
+            start = int(kwargs.get('cursor') or 0)
+            end = start + int(kwargs.get('limit') or len(self.users))
+            cursor = str(end) if end < len(self.users) else ''
+            return {'ok': True, 'members': self.users[start:end], 'response_metadata': {'next_cursor': cursor}}
+        if method == 'users.info':
+            for user in self.users:
+                if user['id'] == kwargs['user']:
+                    return {'ok': True, 'user': user}
+            return {'ok': False, 'error': 'user_not_found'}
+        if method == 'groups.list':
+            return {'ok': True, 'groups': self.groups}
+        if method == 'conversations.list':
+            # A DM for everybody on the team
+            start = int(kwargs.get('cursor') or 0)
+            end = start + int(kwargs.get('limit') or len(self.users))
+            cursor = str(end) if end < len(self.users) else ''
+            channels = [{'id': 'D' + user['id'][1:], 'is_im': True, 'user': user['id']} for user in self.users[start:end]]
+            return {'ok': True, 'channels': channels, 'response_metadata': {'next_cursor': cursor}}
+        if method == 'conversations.history':
+            # Newest first, like Slack. The cursor is how many we've already given back.
+            with self.lock:
+                messages = [dict(message) for message in self.history.get(kwargs['channel'], [])
+                            if float(message['ts']) > float(kwargs.get('oldest') or 0)]
+            messages.reverse()
+            for message in messages:
+                del message['channel']
+            start = int(kwargs.get('cursor') or 0)
+            end = start + int(kwargs.get('limit') or 100)
+            more = end < len(messages)
+            return {'ok': True, 'messages': messages[start:end], 'has_more': more,
+                    'response_metadata': {'next_cursor': str(end) if more else ''}}
+        return {'ok': True}
+
+class FakeWebAPI(object):
+    '''
+    Serves client's Web API over HTTP on localhost, the way slack.com/api/
+    does. ratelimit() makes the next few calls to a method get a 429 with
+    a Retry-After, like Slack does when we go too fast. add() puts more
+    teams behind it, each picked by the token the call comes with. '''
+
+    def __init__(self, client):
+        self.client = client
+        self.clients = {}
+        self.limited = {}
+        self.connections = 0
+        self.lock = threading.Lock()
+        stub = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                super().setup()
+                # Headers and body go out in separate writes, which Nagle would hold up on a kept-alive connection
+                self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                with stub.lock:
+                    stub.connections += 1
+
+            def do_POST(self):
+                method = self.path.rsplit('/', 1)[-1]
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                kwargs = parse_form(self.headers.get('Content-Type', ''), body)
+                with stub.lock:
+                    retryAfter = stub.limited.get(method)
+                    if retryAfter:
+                        retryAfter[1] -= 1
+                        if not retryAfter[1]:
+                            del stub.limited[method]
+                if retryAfter:
+                    self.respond(429, {'ok': False, 'error': 'ratelimited'}, {'Retry-After': str(retryAfter[0])})
+                else:
+                    token = self.headers.get('Authorization', '')[len('Bearer '):]
+                    self.respond(200, stub.clients.get(token, stub.client).api_call(method, **kwargs))
+
+            def respond(self, status, response, headers={}):
+                data = json.dumps(response).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.url = 'http://127.0.0.1:%d/api/' % self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def add(self, token, client):
+        self.clients[token] = client
+
+    def ratelimit(self, method, retryAfter=1, times=1):
+        with self.lock:
+            self.limited[method] = [retryAfter, times]
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+def parse_form(contentType, body):
+    # The arguments of a Web API call, whether they came form encoded or as a file upload
+    if contentType.startswith('multipart/form-data'):
+        message = email.parser.BytesParser().parsebytes(b'Content-Type: ' + contentType.encode() + b'\r\n\r\n' + body)
+        kwargs = {}
+        for part in message.get_payload():
+            kwargs[part.get_param('name', header='content-disposition')] = part.get_payload(decode=True).decode()
+        return kwargs
+    return dict((key, values[-1]) for key, values in urllib.parse.parse_qs(body.decode()).items())
@@ -0,0 +1,144 @@
+#!/usr/bin/python3
+
+import bisect
+import http.server
+import threading
+
+# Counters, gauges and histograms for watching the bot, served over HTTP in
+# the Prometheus text format. Everything can be updated from any thread.
+
+# Histogram bucket bounds, in seconds
+BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for name, value in pairs) + '}'
+
+class Metric(object):
+
+    kind = None
+
+    def __init__(self, name, help, labels=(), registry=None):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+        (registry if registry is not None else REGISTRY).append(self)
+
+    def key(self, labels):
+        return tuple(labels.get(name, '') for name in self.labels)
+
+    def render(self):
+        lines = ['# HELP ' + self.name + ' ' + self.help, '# TYPE ' + self.name + ' ' + self.kind]
+        with self.lock:
+            samples = list(self.samples())
+        for suffix, values, extra, value in samples:
+            lines.append(self.name + suffix + format_labels(self.labels, values, extra) + ' ' + repr(float(value)))
+        return lines
+
+class Counter(Metric):
+    # Something that only ever goes up, like how many commands we've handled
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        for key, value in self.values.items():
+            yield '', key, (), value
+
+class Gauge(Metric):
+    # Something that goes up and down. It can be set, or read from a function when we're scraped
+
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    def set_function(self, function, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = function
+
+    def samples(self):
+        for key, value in self.values.items():
+            yield '', key, (), value() if callable(value) else value
+
+class Histogram(Metric):
+    '''
+    How long things take. Each set of labels keeps a count for every
+    bucket plus the sum and count of everything observed. '''
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS, registry=None):
+        super().__init__(name, help, labels, registry)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    def samples(self):
+        for key, counts in self.values.items():
+            total = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                total += count
+                yield '_bucket', key, (('le', bound),), total
+            yield '_sum', key, (), counts[-1]
+            yield '_count', key, (), total
+
+# Every metric made without its own registry ends up here
+REGISTRY = []
+
+def render(registry=None):
+    # All the metrics in the Prometheus text format
+    lines = []
+    for metric in (registry if registry is not None else REGISTRY):
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+def serve(port, host='127.0.0.1', registry=None, health=None):
+    '''
+    Serves /metrics on host:port from a background thread. If there's a
+    health function, /health answers 200 when it returns true and 503 when
+    it doesn't. Returns the server so it can be shut down. '''
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            path = self.path.split('?')[0]
+            if path == '/health' and health:
+                healthy = health()
+                self.respond(200 if healthy else 503, b'ok\n' if healthy else b'unhealthy\n')
+            elif path == '/metrics':
+                self.respond(200, render(registry).encode())
+            else:
+                self.send_error(404)
+
+        def respond(self, status, data):
+            self.send_response(status)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,133 @@
+#!/usr/bin/python3
+
+# Every change ever made to the shape of team.db, in order. The version a
+# database is at lives in SQLite's user_version, so starting the bot only
+# runs the steps it hasn't had yet and never throws anybody's time away.
+# To change the schema, add a new step to the end of MIGRATIONS. Don't
+# edit old ones, since databases out there have already run them.
+
+import logging
+
+log = logging.getLogger('timebot')
+
+def create_users(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS users (id TEXT PRIMARY KEY, realName TEXT, checkInDate INTEGER, timeLateThisWeek REAL, totalTimeLate REAL,
+                                    clockedIn INTEGER, timeClockedInAt REAL, timeSpentThisWeek REAL, totalTimeSpent REAL, active INTEGER)''')
+
+def add_users_primary_key(c):
+    # Databases from before migrations have no primary key on id, so copy them into a table that does
+    if any(column[1] == 'id' and column[5] for column in c.execute('PRAGMA table_info(users)')):
+        return
+    c.execute('''CREATE TABLE users_new (id TEXT PRIMARY KEY, realName TEXT, checkInDate INTEGER, timeLateThisWeek REAL, totalTimeLate REAL,
+                                    clockedIn INTEGER, timeClockedInAt REAL, timeSpentThisWeek REAL, totalTimeSpent REAL, active INTEGER)''')
+    c.execute('''INSERT OR REPLACE INTO users_new SELECT * FROM users''')
+    c.execute('''DROP TABLE users''')
+    c.execute('''ALTER TABLE users_new RENAME TO users''')
+
+def create_events(c):
+    c.execute('''CREATE INDEX IF NOT EXISTS users_active ON users (active)''')
+    c.execute('''CREATE INDEX IF NOT EXISTS users_checkInDate ON users (checkInDate)''')
+
+    # Every clock event ever. 'in' events hold how late somebody was, 'out'
+    # events how long they worked, and a 'reset' marks the start of a new week.
+    c.execute('''CREATE TABLE IF NOT EXISTS events (id INTEGER PRIMARY KEY, user TEXT, kind TEXT, timestamp REAL, seconds REAL)''')
+    c.execute('''CREATE INDEX IF NOT EXISTS events_user ON events (user, timestamp)''')
+    c.execute('''CREATE INDEX IF NOT EXISTS events_timestamp ON events (timestamp)''')
+    c.execute('''CREATE INDEX IF NOT EXISTS events_kind ON events (kind, timestamp)''')
+
+    # The same totals the users table keeps, worked out from the events
+    c.execute('''CREATE VIEW IF NOT EXISTS week_totals AS
+                    SELECT user, TOTAL(CASE WHEN kind='in' THEN seconds END) AS timeLateThisWeek,
+                                 TOTAL(CASE WHEN kind='out' THEN seconds END) AS timeSpentThisWeek
+                    FROM events
+                    WHERE kind IN ('in', 'out')
+                      AND timestamp >= (SELECT IFNULL(MAX(timestamp), 0) FROM events WHERE kind='reset')
+                    GROUP BY user''')
+    c.execute('''CREATE VIEW IF NOT EXISTS semester_totals AS
+                    SELECT user, TOTAL(CASE WHEN kind='in' THEN seconds END) AS totalTimeLate,
+                                 TOTAL(CASE WHEN kind='out' THEN seconds END) AS totalTimeSpent
+                    FROM events
+                    WHERE kind IN ('in', 'out')
+                    GROUP BY user''')
+
+def create_processed(c):
+    # The Slack messages we've handled, so one delivered twice isn't handled twice
+    c.execute('''CREATE TABLE IF NOT EXISTS processed (channel TEXT, ts TEXT, timestamp REAL, PRIMARY KEY (channel, ts))''')
+    c.execute('''CREATE INDEX IF NOT EXISTS processed_timestamp ON processed (timestamp)''')
+
+def create_weeks(c):
+    # What everybody's week looked like when it ended
+    c.execute('''CREATE TABLE IF NOT EXISTS weeks (ending REAL, user TEXT, realName TEXT, timeLate REAL, timeSpent REAL,
+                                                   PRIMARY KEY (ending, user))''')
+    c.execute('''CREATE INDEX IF NOT EXISTS weeks_user ON weeks (user, ending)''')
+
+def index_open_sessions(c):
+    # So finding everybody who forgot to clock out only looks at who's clocked in
+    c.execute('''CREATE INDEX IF NOT EXISTS users_open ON users (clockedIn, timeClockedInAt)''')
+
+def create_daily(c):
+    # Everybody's clock events added up by day, with the day as a date ordinal
+    c.execute('''CREATE TABLE IF NOT EXISTS daily (user TEXT, day INTEGER, timeLate REAL, timeSpent REAL, clockIns INTEGER,
+                                                   PRIMARY KEY (user, day))''')
+    c.execute('''INSERT OR REPLACE INTO daily (user, day, timeLate, timeSpent, clockIns)
+                 SELECT user, CAST(julianday(date(timestamp, 'unixepoch', 'localtime')) - 1721424.5 AS INTEGER),
+                        TOTAL(CASE WHEN kind='in' THEN seconds END), TOTAL(CASE WHEN kind='out' THEN seconds END),
+                        COUNT(CASE WHEN kind='in' THEN 1 END)
+                 FROM events WHERE kind IN ('in', 'out') GROUP BY 1, 2''')
+
+def create_caught_up(c):
+    # Where the last catch-up that finished got to, starting from the newest message handled so far
+    c.execute('''CREATE TABLE IF NOT EXISTS caught_up (id INTEGER PRIMARY KEY CHECK (id = 0), ts TEXT)''')
+    c.execute('''INSERT OR IGNORE INTO caught_up (id, ts) SELECT 0, ts FROM processed ORDER BY timestamp DESC LIMIT 1''')
+
+def create_monthly(c):
+    # Everybody's clock events added up by month, keyed by the ordinal of the first of the month, out of the daily table
+    c.execute('''CREATE TABLE IF NOT EXISTS monthly (user TEXT, month INTEGER, timeLate REAL, timeSpent REAL, clockIns INTEGER,
+                                                     PRIMARY KEY (user, month))''')
+    c.execute('''INSERT OR REPLACE INTO monthly (user, month, timeLate, timeSpent, clockIns)
+                 SELECT user, CAST(julianday(date(day + 1721424.5, 'start of month')) - 1721424.5 AS INTEGER),
+                        TOTAL(timeLate), TOTAL(timeSpent), TOTAL(clockIns)
+                 FROM daily GROUP BY 1, 2''')
+
+def create_streaks(c):
+    # How each person's on time streak stood at the end of the day through, so !streak only reads the days after it
+    c.execute('''CREATE TABLE IF NOT EXISTS streaks (user TEXT PRIMARY KEY, through INTEGER, run INTEGER, longest INTEGER)''')
+
+def drop_event_totals(c):
+    # Nothing ever read week_totals or semester_totals, and the daily and monthly tables answer the same questions
+    c.execute('''DROP VIEW IF EXISTS week_totals''')
+    c.execute('''DROP VIEW IF EXISTS semester_totals''')
+
+MIGRATIONS = [
+    create_users,
+    add_users_primary_key,
+    create_events,
+    create_processed,
+    create_weeks,
+    index_open_sessions,
+    create_daily,
+    create_caught_up,
+    create_monthly,
+    create_streaks,
+    drop_event_totals,
+]
+
+def migrate(conn):
+    '''
+    Brings the database up to the newest schema. Each step runs in its own
+    transaction along with bumping the version, so if one fails the
+    database is left at the last version that worked. Returns the version
+    it ended up at. '''
+
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    for number, step in enumerate(MIGRATIONS[version:], version + 1):
+        conn.execute('BEGIN')
+        try:
+            step(conn.cursor())
+            conn.execute('PRAGMA user_version = ' + str(number))
+            conn.commit()
+        except:
+            conn.rollback()
+            raise
+        log.info("upgraded the database version=%d step=%s", number, step.__name__)
+    return len(MIGRATIONS)
@@ -0,0 +1,112 @@
+#!/usr/bin/python3
+
+import datetime
+import json
+import os
+
+# When everybody is supposed to be in. schedule.json can change any of this:
+#   "start":    weekday name -> "H:MM". Days that aren't listed have no start time.
+#   "holidays": dates ("YYYY-MM-DD") with no start time.
+#   "users":    Slack id -> weekday name -> "H:MM", or null for a day they don't have to come in.
+#   "rollover": "weekday H:MM" when the week ends and the standings reset, or null to only reset by hand.
+DEFAULT_SCHEDULE = {
+    'start': {'monday': '8:00', 'tuesday': '8:00', 'wednesday': '7:30', 'thursday': '8:00', 'friday': '8:00'},
+    'holidays': [],
+    'users': {},
+    'rollover': 'monday 0:00',
+}
+
+WEEKDAYS = ('monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday')
+
+# How many days on each side of today get worked out up front
+PRECOMPUTE_DAYS = 366
+
+def parse_time(text):
+    # "7:30" -> seconds after midnight
+    hours, minutes = text.split(':')
+    return int(hours) * 3600 + int(minutes) * 60
+
+def parse_rollover(text):
+    # "sunday 23:59" -> (weekday number, seconds after midnight)
+    if not text:
+        return None
+    day, time = text.split()
+    return WEEKDAYS.index(day.lower()), parse_time(time)
+
+def parse_week(days):
+    # A weekday name -> "H:MM" mapping, as a list of seconds after midnight (or None) by weekday number
+    return [parse_time(days[name]) if days.get(name) else None for name in WEEKDAYS]
+
+class Schedule(object):
+    '''
+    Start times by date. Everything in the config gets turned into a
+    table of (date ordinal, user override) -> the timestamp they're due
+    in, so finding out how late somebody was is one dict lookup. Days
+    outside the precomputed range get worked out the first time they come
+    up and remembered after that. '''
+
+    def __init__(self, config):
+        self.week = parse_week(config.get('start', {}))
+        self.holidays = set(datetime.datetime.strptime(day, '%Y-%m-%d').date().toordinal()
+                            for day in config.get('holidays', []))
+        self.users = {}
+        for userId, days in config.get('users', {}).items():
+            week = list(self.week)
+            for name, text in days.items():
+                week[WEEKDAYS.index(name)] = parse_time(text) if text else None
+            self.users[userId] = week
+        self.rollover = parse_rollover(config.get('rollover', DEFAULT_SCHEDULE['rollover']))
+
+        self.table = {}
+        today = datetime.date.today().toordinal()
+        for ordinal in range(today - PRECOMPUTE_DAYS, today + PRECOMPUTE_DAYS + 1):
+            self.table[ordinal, None] = self.compute(ordinal, None)
+
+    def compute(self, ordinal, userId):
+        # The timestamp somebody is due in on a day, or None if they don't have to come in
+        if ordinal in self.holidays:
+            return None
+        day = datetime.date.fromordinal(ordinal)
+        start = (self.users[userId] if userId else self.week)[day.weekday()]
+        if start is None:
+            return None
+        return datetime.datetime.combine(day, datetime.time()).timestamp() + start
+
+    def start(self, day, userId=None):
+        # When userId was due in on day, as a timestamp, or None if it's a day off for them
+        key = (day.toordinal(), userId if userId in self.users else None)
+        try:
+            return self.table[key]
+        except KeyError:
+            start = self.table[key] = self.compute(*key)
+            return start
+
+    def lateness(self, timestamp, userId=None):
+        # How many seconds late somebody was if they came in at timestamp
+        start = self.start(datetime.date.fromtimestamp(timestamp), userId)
+        if start is None or timestamp < start:
+            return 0
+        return timestamp - start
+
+    def last_rollover(self, timestamp):
+        # The timestamp of the newest week rollover at or before timestamp
+        weekday, start = self.rollover
+        day = datetime.date.fromtimestamp(timestamp)
+        day -= datetime.timedelta(days=(day.weekday() - weekday) % 7)
+        rollover = datetime.datetime.combine(day, datetime.time()).timestamp() + start
+        if rollover > timestamp:
+            day -= datetime.timedelta(days=7)
+            rollover = datetime.datetime.combine(day, datetime.time()).timestamp() + start
+        return rollover
+
+    def next_rollover(self, timestamp):
+        # The timestamp of the first week rollover after timestamp
+        day = datetime.date.fromtimestamp(self.last_rollover(timestamp)) + datetime.timedelta(days=7)
+        return datetime.datetime.combine(day, datetime.time()).timestamp() + self.rollover[1]
+
+def load_schedule(fileName):
+    # Reads the schedule out of fileName, or uses the default one if it isn't there
+    if not os.path.isfile(fileName):
+        return Schedule(DEFAULT_SCHEDULE)
+    with open(fileName) as f:
+        return Schedule(json.load(f))
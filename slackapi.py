@@ -0,0 +1,280 @@
+#!/usr/bin/python3
+
+import concurrent.futures
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Talks to Slack's Web API for the bot. Every call goes over one pooled HTTP
+# session, so we aren't doing a new TLS handshake for every reply, and runs
+# on a few worker threads so command handling never waits on Slack. A call
+# only gets a worker once its rate limit lets it go, so the workers are
+# always sending something instead of sleeping.
+
+log = logging.getLogger('timebot')
+
+SLACK_API_URL = 'https://slack.com/api/'
+
+# How many calls per second we let ourselves make to each method, and how
+# many we can make at once before that kicks in, roughly following Slack's
+# rate limit tiers. Anything that isn't listed gets 'default'.
+RATE_LIMITS = {
+    'default': (1.0, 20),
+    'chat.postMessage': (1.0, 20),
+    'reactions.add': (1.0, 50),
+    'files.upload': (.3, 5),
+    'conversations.history': (1.0, 50),
+}
+
+# How many times a call gets retried when Slack says we're going too fast
+MAX_RETRIES = 3
+
+# How many seconds we give Slack to answer before giving up on a call
+REQUEST_TIMEOUT = 30
+
+# How long to hold a reply in case more for the same channel come right behind it
+COALESCE_DELAY = .2
+
+class TokenBucket(object):
+    '''
+    Lets rate calls through per second, with up to burst of them at
+    once. When Slack tells us to back off, pause() stops everything
+    until it says we can go again. '''
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blockedUntil = 0
+        self.lock = threading.Lock()
+
+    def take(self):
+        # Blocks until there's a token for us
+        wait = self.reserve()
+        while wait:
+            time.sleep(wait)
+            wait = self.reserve()
+
+    def reserve(self):
+        # Takes a token and returns 0 if there is one, or how many seconds until there might be
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if now >= self.blockedUntil and self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return max(self.blockedUntil - now, (1 - self.tokens) / self.rate)
+
+    def pause(self, seconds):
+        with self.lock:
+            self.blockedUntil = max(self.blockedUntil, time.monotonic() + seconds)
+            self.tokens = 0
+
+class Scheduler(object):
+    '''
+    Runs functions after a delay, all on one thread of its own, for calls
+    waiting on their rate limit. The thread starts with the first one. '''
+
+    def __init__(self):
+        self.heap = []
+        self.order = itertools.count()
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def later(self, delay, function, *args):
+        with self.condition:
+            heapq.heappush(self.heap, (time.monotonic() + delay, next(self.order), function, args))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='slackapi-scheduler', daemon=True)
+                self.thread.start()
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.heap or self.heap[0][0] > time.monotonic():
+                    self.condition.wait(self.heap[0][0] - time.monotonic() if self.heap else None)
+                when, order, function, args = heapq.heappop(self.heap)
+            try:
+                function(*args)
+            except Exception:
+                log.exception("scheduled Slack call failed")
+
+# Every client waits out its rate limits here
+SCHEDULER = Scheduler()
+
+class SlackWebClient(object):
+    '''
+    Sends Web API calls for one token. call() blocks and gives back the
+    response like SlackClient.api_call does, and submit() sends it from
+    the worker pool and gives back a future for it. Either way, if Slack
+    can't be reached or doesn't answer with JSON the response is ok=False
+    with what went wrong as the error, and it gets logged. With coalesce on,
+    chat.postMessage calls to the same channel that come within
+    COALESCE_DELAY of each other go out as one message. limits takes the
+    place of RATE_LIMITS and needs a 'default'. Clients for different
+    workspaces can share one worker pool and session (see make_session),
+    so serving more teams doesn't mean more threads or connections. Those
+    are left open by close(). '''
+
+    def __init__(self, token, baseUrl=SLACK_API_URL, workers=4, limits=None, coalesce=False, session=None, executor=None):
+        self.token = token
+        self.baseUrl = baseUrl
+        self.limits = limits or RATE_LIMITS
+        self.buckets = {}
+        self.coalesce = coalesce
+        self.batches = {}
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.shared = executor is not None, session is not None
+        self.executor = executor or make_executor(workers)
+        self.session = session or make_session(workers)
+
+    def bucket(self, method):
+        with self.lock:
+            if method not in self.buckets:
+                self.buckets[method] = TokenBucket(*self.limits.get(method, self.limits['default']))
+            return self.buckets[method]
+
+    def call(self, method, **kwargs):
+        # Sends the call right here and returns Slack's response
+        bucket = self.bucket(method)
+        for attempt in range(MAX_RETRIES + 1):
+            bucket.take()
+            response, retryAfter = self.post(method, kwargs)
+            if retryAfter is None or attempt == MAX_RETRIES:
+                return response
+            bucket.pause(retryAfter)
+
+    def post(self, method, kwargs):
+        '''
+        One try at a call. Returns Slack's response, and how many seconds
+        it said to wait if it rate limited us (or None if it didn't). '''
+
+        data = dict(kwargs)
+        files = None
+        if 'file' in data:
+            upload = data.pop('file')
+            upload.seek(0)
+            files = {'file': (data.get('filename', 'file'), upload)}
+        try:
+            response = self.session.post(self.baseUrl + method, data=data, files=files, timeout=REQUEST_TIMEOUT,
+                                         headers={'Authorization': 'Bearer ' + (self.token or '')})
+            if response.status_code == 429:
+                return {'ok': False, 'error': 'ratelimited'}, float(response.headers.get('Retry-After', 1))
+            return response.json(), None
+        except (requests.RequestException, ValueError) as e:
+            log.error("Slack API call failed method=%s error=%r", method, e)
+            return {'ok': False, 'error': type(e).__name__}, None
+
+    # So it can stand in for a SlackClient, like for the UserDirectory
+    api_call = call
+
+    def submit(self, method, **kwargs):
+        # Sends the call from the worker pool and returns a future for the response
+        if self.coalesce and method == 'chat.postMessage':
+            return self.add_to_batch(kwargs)
+        future = self.track(concurrent.futures.Future())
+        self.send(method, kwargs, future)
+        return future
+
+    def send(self, method, kwargs, future, attempt=0):
+        # Hands the call to a worker once its bucket has a token for it, waiting on the scheduler until then
+        wait = self.bucket(method).reserve()
+        if wait:
+            SCHEDULER.later(wait, self.send, method, kwargs, future, attempt)
+        else:
+            self.executor.submit(self.finish, method, kwargs, future, attempt)
+
+    def finish(self, method, kwargs, future, attempt):
+        # Runs on a worker: sends the call, and either answers future or lines up a retry
+        try:
+            response, retryAfter = self.post(method, kwargs)
+        except Exception as e:
+            log.exception("Slack API call failed method=%s", method)
+            future.set_exception(e)
+            return
+        if retryAfter is not None and attempt < MAX_RETRIES:
+            self.bucket(method).pause(retryAfter)
+            self.send(method, kwargs, future, attempt + 1)
+        else:
+            future.set_result(response)
+
+    def track(self, future):
+        with self.lock:
+            self.pending.add(future)
+        future.add_done_callback(self.done)
+        return future
+
+    def done(self, future):
+        with self.lock:
+            self.pending.discard(future)
+
+    def add_to_batch(self, kwargs):
+        '''
+        Holds a message until COALESCE_DELAY after the first one for its
+        channel. Anything else for that channel with the same options gets
+        added on as another line, and they all share one future. '''
+
+        channel = kwargs['channel']
+        options = dict((key, value) for key, value in kwargs.items() if key != 'text')
+        with self.lock:
+            batch = self.batches.get(channel)
+            if batch and batch['options'] == options:
+                batch['lines'].append(kwargs.get('text', ''))
+                return batch['future']
+        if batch:
+            # Something like a different username can't go out in the same message
+            self.flush(channel)
+
+        batch = {'options': options, 'lines': [kwargs.get('text', '')], 'future': concurrent.futures.Future()}
+        batch['timer'] = threading.Timer(COALESCE_DELAY, self.flush, (channel,))
+        with self.lock:
+            self.batches[channel] = batch
+            self.pending.add(batch['future'])
+        batch['future'].add_done_callback(self.done)
+        batch['timer'].start()
+        return batch['future']
+
+    def flush(self, channel):
+        # Sends whatever is being held for channel
+        with self.lock:
+            batch = self.batches.pop(channel, None)
+        if batch is None:
+            return
+        batch['timer'].cancel()
+        self.send('chat.postMessage', dict(batch['options'], text='\n'.join(batch['lines'])), batch['future'])
+
+    def wait(self, timeout=None):
+        # Blocks until every call we've sent off so far is done, held messages included
+        for channel in list(self.batches):
+            self.flush(channel)
+        with self.lock:
+            pending = list(self.pending)
+        concurrent.futures.wait(pending, timeout=timeout)
+
+    def close(self):
+        self.wait()
+        sharedExecutor, sharedSession = self.shared
+        if not sharedExecutor:
+            self.executor.shutdown()
+        if not sharedSession:
+            self.session.close()
+
+def make_executor(workers):
+    return concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='slackapi')
+
+def make_session(workers):
+    # A session that keeps a connection around for every worker
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
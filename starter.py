@@ -1,20 +1,20 @@
 import os
 from slackclient import SlackClient
 
+from directory import UserDirectory
+
 
 BOT_NAME = 'timebot'
 
 slack_client = SlackClient(os.environ.get('SLACK_BOT_TOKEN'))
+directory = UserDirectory(slack_client)
 
 
 if __name__ == "__main__":
-    api_call = slack_client.api_call("users.list")
-    if api_call.get('ok'):
-        # retrieve all users so we can find our bot
-        users = api_call.get('members')
-        for user in users:
-            if 'name' in user and user.get('name') == BOT_NAME:
-                print("Bot ID for '" + user['name'] + "' is " + user.get('id'))
+    # go through all the users so we can find our bot
+    user = directory.find(BOT_NAME)
+    if user:
+        print("Bot ID for '" + user['name'] + "' is " + user.get('id'))
     else:
        print("could not find bot user with the name " + BOT_NAME)
                                                                                             
@@ -0,0 +1,433 @@
+#!/usr/bin/python3
+
+import collections
+import datetime
+import heapq
+import sqlite3
+import time
+
+from analytics import Analytics, month_of
+
+# The users table, kept in memory so handlers don't have to ask SQLite
+# every time they want to know about somebody.
+
+# Columns we keep running totals of over everybody who is active
+TOTALED = ('timeLateThisWeek', 'totalTimeLate', 'timeSpentThisWeek', 'totalTimeSpent')
+
+# Columns we keep leaderboards for
+RANKED = ('timeLateThisWeek', 'timeSpentThisWeek')
+
+# How long, and how many, handled messages we remember so they don't get handled twice
+DEDUP_WINDOW = 24 * 3600
+DEDUP_SIZE = 50000
+
+COLUMNS = ('id', 'realName', 'checkInDate', 'timeLateThisWeek', 'totalTimeLate',
+           'clockedIn', 'timeClockedInAt', 'timeSpentThisWeek', 'totalTimeSpent', 'active')
+
+def connect(dbName):
+    '''
+    Opens the database in WAL mode, where a commit only appends to the log.
+    With synchronous=NORMAL that's safe if the bot crashes, and only the
+    last few commits can be lost if the whole machine loses power. '''
+
+    conn = sqlite3.connect(dbName)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+def sync_users(c, members):
+    '''
+    Brings the users table in line with Slack's member list, only writing
+    the rows that changed. New people get added (inactive), people whose
+    name changed get renamed, and nobody is deleted, so their time is
+    kept. Returns how many were added and how many renamed. '''
+
+    names = dict(c.execute('''SELECT id, realName FROM users'''))
+    added = []
+    renamed = []
+    for user in members:
+        if user['is_bot']:
+            continue
+        if user['id'] not in names:
+            added.append((user['id'], user['name']))
+        elif names[user['id']] != user['name']:
+            renamed.append((user['name'], user['id']))
+
+    c.executemany('INSERT INTO users VALUES (?, ?, 0, 0.0, 0.0, 0, 0.0, 0.0, 0.0, 0)', added)
+    c.executemany('UPDATE users SET realName=? WHERE id=?', renamed)
+    return len(added), len(renamed)
+
+class User(object):
+    '''
+    One row of the users table. Use UserStore.update to change it so the
+    database stays in step. '''
+
+    __slots__ = COLUMNS
+
+    def __init__(self, *row):
+        for name, value in zip(COLUMNS, row):
+            setattr(self, name, value)
+
+def rebuild_rollups(c):
+    # Works the daily and monthly tables out from scratch from the events, for when the events were changed underneath them
+    c.execute('''DELETE FROM daily''')
+    c.execute('''INSERT INTO daily (user, day, timeLate, timeSpent, clockIns)
+                 SELECT user, CAST(julianday(date(timestamp, 'unixepoch', 'localtime')) - 1721424.5 AS INTEGER),
+                        TOTAL(CASE WHEN kind='in' THEN seconds END), TOTAL(CASE WHEN kind='out' THEN seconds END),
+                        COUNT(CASE WHEN kind='in' THEN 1 END)
+                 FROM events WHERE kind IN ('in', 'out') GROUP BY 1, 2''')
+    c.execute('''DELETE FROM monthly''')
+    c.execute('''INSERT INTO monthly (user, month, timeLate, timeSpent, clockIns)
+                 SELECT user, CAST(julianday(date(day + 1721424.5, 'start of month')) - 1721424.5 AS INTEGER),
+                        TOTAL(timeLate), TOTAL(timeSpent), TOTAL(clockIns)
+                 FROM daily GROUP BY 1, 2''')
+    # Streaks saved from the old days (or an old schedule) would be wrong now, so they get worked out again
+    c.execute('''DELETE FROM streaks''')
+
+class EventLog(object):
+    '''
+    The events table. New events wait in memory until flush(), so a whole
+    batch of commands gets appended with one executemany. Each person's
+    clock events are also added into their rows of the daily and monthly
+    tables for the day they happened, and a clock-in on a day their saved
+    streak already covers throws the streak away. onLog gets called with
+    the user's id whenever one of their events is logged. '''
+
+    def __init__(self, c, onLog=None):
+        self.c = c
+        self.onLog = onLog
+        self.pending = []
+
+    def log(self, userId, kind, seconds=0.0, timestamp=None):
+        timestamp = time.time() if timestamp is None else timestamp
+        # The day is worked out here, so a timestamp that isn't on any day fails the command that logged it, not the flush
+        day = datetime.date.fromtimestamp(timestamp).toordinal()
+        self.pending.append((userId, kind, timestamp, seconds, day))
+        if self.onLog:
+            self.onLog(userId)
+
+    def flush(self):
+        if self.pending:
+            self.c.executemany('INSERT INTO events (user, kind, timestamp, seconds) VALUES (?, ?, ?, ?)',
+                               [event[:4] for event in self.pending])
+            days = {}
+            for userId, kind, timestamp, seconds, day in self.pending:
+                if kind not in ('in', 'out'):
+                    continue
+                key = (userId, day)
+                late, spent, clockIns = days.get(key, (0.0, 0.0, 0))
+                if kind == 'in':
+                    days[key] = (late + seconds, spent, clockIns + 1)
+                else:
+                    days[key] = (late, spent + seconds, clockIns)
+            self.c.executemany('INSERT OR IGNORE INTO daily (user, day, timeLate, timeSpent, clockIns) VALUES (?, ?, 0.0, 0.0, 0)', days)
+            self.c.executemany('''UPDATE daily SET timeLate=timeLate+?, timeSpent=timeSpent+?, clockIns=clockIns+?
+                                  WHERE user=? AND day=?''', [value + key for key, value in days.items()])
+            months = {}
+            for (userId, day), (late, spent, clockIns) in days.items():
+                key = (userId, month_of(day))
+                monthLate, monthSpent, monthClockIns = months.get(key, (0.0, 0.0, 0))
+                months[key] = (monthLate + late, monthSpent + spent, monthClockIns + clockIns)
+            self.c.executemany('INSERT OR IGNORE INTO monthly (user, month, timeLate, timeSpent, clockIns) VALUES (?, ?, 0.0, 0.0, 0)', months)
+            self.c.executemany('''UPDATE monthly SET timeLate=timeLate+?, timeSpent=timeSpent+?, clockIns=clockIns+?
+                                  WHERE user=? AND month=?''', [value + key for key, value in months.items()])
+            self.c.executemany('DELETE FROM streaks WHERE user=? AND through >= ?',
+                               [key for key, value in days.items() if value[2]])
+            self.pending = []
+
+    def last_reset(self):
+        # When the week was last reset, or None if it never has been
+        self.flush()
+        return self.c.execute('''SELECT MAX(timestamp) FROM events WHERE kind='reset' ''').fetchone()[0]
+
+    def clocked_in_on(self, day):
+        # Everybody who clocked in on a date, out of the events for just that day
+        self.flush()
+        start = datetime.datetime.combine(day, datetime.time()).timestamp()
+        end = datetime.datetime.combine(day + datetime.timedelta(days=1), datetime.time()).timestamp()
+        return set(row[0] for row in self.c.execute('''SELECT DISTINCT user FROM events WHERE kind='in' AND timestamp >= ? AND timestamp < ?''',
+                                                    (start, end)))
+
+class ProcessedMessages(object):
+    '''
+    The (channel, ts) of every message handled in the last window seconds,
+    so one that gets delivered twice only gets handled once. New ones wait
+    in memory until flush() like events do, so they're saved in the same
+    transaction as whatever the command changed and a restart remembers
+    them too. Only the newest size of them are kept.
+
+    caughtUp is the ts of the last catch-up to finish: every DM message
+    sent before it has been handled. Only catch_up_to() moves it, so
+    messages handled while a catch-up is still going don't. '''
+
+    def __init__(self, c, window=DEDUP_WINDOW, size=DEDUP_SIZE):
+        self.c = c
+        self.window = window
+        self.size = size
+        self.seen = set()
+        self.order = collections.deque()
+        self.pending = []
+        self.newest = None
+        # The last window of them, however long ago that was
+        for channel, ts in c.execute('''SELECT channel, ts FROM processed
+                                        WHERE timestamp >= (SELECT MAX(timestamp) FROM processed) - ? ORDER BY timestamp''',
+                                     (window,)).fetchall():
+            self.remember(channel, ts)
+        row = c.execute('SELECT ts FROM caught_up').fetchone()
+        self.caughtUp = row[0] if row else None
+        self.caughtUpPending = False
+
+    def __contains__(self, key):
+        return key in self.seen
+
+    def horizon(self):
+        # The ts of the oldest message we still remember handling, or None. Anything older can't be told apart from one we missed.
+        return self.order[0][0] if self.order else None
+
+    def catch_up_to(self, ts):
+        # Marks every message sent before ts handled, once a catch-up has finished and what it found has been handled
+        self.caughtUp = ts
+        self.caughtUpPending = True
+
+    def add(self, channel, ts):
+        # Marks a message handled. Returns False if it already was.
+        if (channel, ts) in self.seen:
+            return False
+        self.remember(channel, ts)
+        self.pending.append((channel, ts, float(ts)))
+        return True
+
+    def remember(self, channel, ts):
+        self.seen.add((channel, ts))
+        self.order.append((float(ts), (channel, ts)))
+        if self.newest is None or float(ts) > float(self.newest):
+            self.newest = ts
+        cutoff = float(self.newest) - self.window
+        while self.order and (self.order[0][0] < cutoff or len(self.order) > self.size):
+            self.seen.discard(self.order.popleft()[1])
+
+    def flush(self):
+        if self.pending:
+            self.c.executemany('INSERT OR IGNORE INTO processed (channel, ts, timestamp) VALUES (?, ?, ?)', self.pending)
+            self.c.execute('DELETE FROM processed WHERE timestamp < ?', (float(self.newest) - self.window,))
+            self.pending = []
+        if self.caughtUpPending:
+            self.c.execute('INSERT OR REPLACE INTO caught_up (id, ts) VALUES (0, ?)', (self.caughtUp,))
+            self.caughtUpPending = False
+
+class Attendance(object):
+    '''
+    The ids of everybody who has clocked in today. It starts over on its
+    own the first time it gets used on a new day, from the checkInDate
+    everybody already has. '''
+
+    def __init__(self, users):
+        self.users = users
+        self.day = None
+        self.here = set()
+
+    def today(self):
+        # Today's ordinal, rolling everything over first if it's past midnight
+        today = datetime.date.today().toordinal()
+        if today != self.day:
+            self.day = today
+            self.here = set(user.id for user in self.users.values() if user.checkInDate == today)
+        return today
+
+    def update(self, user):
+        if user.checkInDate == self.today():
+            self.here.add(user.id)
+        else:
+            self.here.discard(user.id)
+
+class Leaderboard(object):
+    '''
+    The top k active users by one column, biggest first, as (value, id)
+    pairs. Only people with something on the board are on it. text is for
+    whoever shows the board to fill in, and gets cleared whenever the
+    top k changes so it knows to build it again. '''
+
+    def __init__(self, column, k):
+        self.column = column
+        self.k = k
+        self.top = []
+        self.text = None
+
+    def value(self, user):
+        return getattr(user, self.column) if user.active else 0
+
+    def set(self, top):
+        if top != self.top:
+            self.top = top
+            self.text = None
+
+    def rebuild(self, users):
+        self.set(heapq.nlargest(self.k, [(self.value(user), user.id) for user in users if self.value(user) > 0]))
+
+    def update(self, user, users):
+        # Fixes up the board after one user's row changed
+        old = next((entry for entry in self.top if entry[1] == user.id), None)
+        value = self.value(user)
+
+        if old and value < old[0]:
+            # They might have fallen out of the top k, so we have to look at everybody
+            self.rebuild(users)
+            return
+
+        if value <= 0 or (not old and len(self.top) == self.k and (value, user.id) < self.top[-1]):
+            # Not good enough to make the board
+            return
+
+        top = [entry for entry in self.top if entry is not old]
+        top.append((value, user.id))
+        top.sort(reverse=True)
+        self.set(top[:self.k])
+
+class UserStore(object):
+    '''
+    Every user keyed by their Slack id. Reads come straight out of memory
+    and writes go through to SQLite right away, so the database is always
+    up to date whenever the connection commits.
+
+    It also keeps totals of the TOTALED columns over the active users,
+    adjusted on every write so reading one never has to add anything up,
+    a Leaderboard for each of the RANKED columns, the sets of active and
+    clocked in ids and today's Attendance. The time columns are really
+    rollups of the events, which are logged through events, and
+    analytics has what each person's days look like. Which messages have
+    been handled already is kept in processed. '''
+
+    def __init__(self, c, leaderboardSize=5):
+        self.c = c
+        self.users = {}
+        self.events = EventLog(c)
+        self.analytics = Analytics(c, self.events)
+        self.events.onLog = self.analytics.forget
+        self.processed = ProcessedMessages(c)
+        for row in c.execute('SELECT ' + ', '.join(COLUMNS) + ' FROM users'):
+            self.users[row[0]] = User(*row)
+        self.recount()
+        self.attendance = Attendance(self.users)
+        self.boards = {}
+        for column in RANKED:
+            self.boards[column] = Leaderboard(column, leaderboardSize)
+            self.boards[column].rebuild(self.users.values())
+
+    def recount(self):
+        self.totals = dict.fromkeys(TOTALED, 0.0)
+        self.active = set()
+        self.clockedIn = set()
+        for user in self.users.values():
+            self.count(user, 1)
+
+    def count(self, user, sign):
+        # Adds (or takes away) one user's share of the totals
+        if user.active:
+            for name in TOTALED:
+                self.totals[name] += sign * getattr(user, name)
+            if sign > 0:
+                self.active.add(user.id)
+                if user.clockedIn:
+                    self.clockedIn.add(user.id)
+            else:
+                self.active.discard(user.id)
+                self.clockedIn.discard(user.id)
+
+    def flush(self):
+        # Writes out the events and handled messages waiting in memory
+        self.events.flush()
+        self.processed.flush()
+
+    def check_totals(self):
+        '''
+        Adds the totals up from scratch in the database and returns the
+        names of any that don't match what we've been keeping. '''
+
+        row = self.c.execute('SELECT ' + ', '.join('TOTAL(' + name + ')' for name in TOTALED) +
+                             ' FROM users WHERE active=1').fetchone()
+        return [name for name, total in zip(TOTALED, row) if abs(total - self.totals[name]) > .001]
+
+    def get(self, userId, activeOnly=False):
+        # The user, or None if they aren't in the database (or aren't active)
+        user = self.users.get(userId)
+        if user is None or (activeOnly and not user.active):
+            return None
+        return user
+
+    def active_users(self):
+        return [self.users[userId] for userId in self.active]
+
+    def absent(self):
+        # Everybody active who hasn't clocked in today
+        self.attendance.today()
+        return [self.users[userId] for userId in self.active - self.attendance.here]
+
+    def add(self, userId, realName):
+        user = User(userId, realName, 0, 0.0, 0.0, 0, 0.0, 0.0, 0.0, 0)
+        self.c.execute('INSERT INTO users VALUES (?, ?, 0, 0.0, 0.0, 0, 0.0, 0.0, 0.0, 0)', (userId, realName))
+        # Nobody starts out active, so the totals don't change
+        self.users[userId] = user
+        return user
+
+    def update(self, user, **changes):
+        # Sets the given columns on one user, in memory and in the database
+        self.count(user, -1)
+        for name, value in changes.items():
+            setattr(user, name, value)
+        self.count(user, 1)
+        for board in self.boards.values():
+            if board.column in changes or 'active' in changes:
+                board.update(user, self.users.values())
+            if 'realName' in changes:
+                board.text = None
+        if 'checkInDate' in changes:
+            self.attendance.update(user)
+        self.c.execute('UPDATE users SET ' + ', '.join(name + '=?' for name in changes) + ' WHERE id=?',
+                       tuple(changes.values()) + (user.id,))
+
+    def update_all(self, **changes):
+        # Sets the given columns on everybody
+        for user in self.users.values():
+            for name, value in changes.items():
+                setattr(user, name, value)
+        self.recount()
+        for board in self.boards.values():
+            board.rebuild(self.users.values())
+        if 'checkInDate' in changes:
+            self.attendance.day = None
+        # Rows that already have those values are left alone
+        self.c.execute('UPDATE users SET ' + ', '.join(name + '=?' for name in changes) +
+                       ' WHERE NOT (' + ' AND '.join(name + ' IS ?' for name in changes) + ')',
+                       tuple(changes.values()) * 2)
+
+    def close_sessions(self, before):
+        '''
+        Clocks out everybody who clocked in before the timestamp before and
+        never clocked out. They don't get any time for it, since we don't
+        know when they left, so their 'out' event is logged at the time they
+        came in. Goes through the index on (clockedIn, timeClockedInAt), so
+        it only looks at people who are clocked in. Returns their users. '''
+
+        rows = self.c.execute('SELECT id FROM users WHERE clockedIn=1 AND timeClockedInAt < ?', (before,)).fetchall()
+        users = [self.users[row[0]] for row in rows]
+        for user in users:
+            self.count(user, -1)
+            user.clockedIn = 0
+            self.count(user, 1)
+            self.events.log(user.id, 'out', 0.0, user.timeClockedInAt)
+        self.c.execute('UPDATE users SET clockedIn=0 WHERE clockedIn=1 AND timeClockedInAt < ?', (before,))
+        return users
+
+    def end_week(self, userId, timestamp=None):
+        '''
+        Saves everybody's week into the weeks table, then zeroes it and
+        clocks everybody out. userId is whoever ended it. All of it goes
+        through c, so it lands in the caller's transaction. '''
+
+        timestamp = time.time() if timestamp is None else timestamp
+        self.c.execute('''INSERT OR REPLACE INTO weeks (ending, user, realName, timeLate, timeSpent)
+                          SELECT ?, id, realName, timeLateThisWeek, timeSpentThisWeek FROM users
+                          WHERE active=1 OR timeLateThisWeek != 0 OR timeSpentThisWeek != 0''', (timestamp,))
+        self.update_all(timeLateThisWeek=0.0, clockedIn=0, timeSpentThisWeek=0.0)
+        self.events.log(userId, 'reset', 0.0, timestamp)
+        self.events.flush()
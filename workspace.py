@@ -0,0 +1,121 @@
+#!/usr/bin/python3
+
+import collections
+import json
+import os
+
+from directory import UserDirectory
+from store import UserStore, connect
+
+# Everything the bot keeps for one Slack workspace: its connections, its own
+# SQLite file (its shard) and what it has in memory about the team. One
+# process can serve any number of them. Only the ones used most recently
+# have their database open and their users in memory, so a team that isn't
+# doing anything costs next to nothing.
+
+# Where the list of workspaces to serve lives
+WORKSPACES_FILE = 'workspaces.json'
+
+class Workspace(object):
+    '''
+    One team. rtm and api are its RTM connection and Web API client, and
+    dbName is its shard. conn, c and store are None until open() is
+    called, and go back to None when shards closes them to make room for
+    another workspace. Nothing is lost, since closing commits first and
+    opening reads everything back. '''
+
+    def __init__(self, name, rtm, api, dbName, schedule, shards, leaderChannel=None, botId=None, leaderboardSize=5):
+        self.name = name
+        self.slack_client = rtm
+        self.web = api
+        self.directory = UserDirectory(api)
+        self.dbName = dbName
+        self.schedule = schedule
+        self.shards = shards
+        self.leaderChannel = leaderChannel
+        self.leader_channel_id = None
+        self.botId = botId
+        self.leaderboardSize = leaderboardSize
+        # How the connection to Slack is doing, see bot.HEALTH_STATES
+        self.health = 'starting'
+        # How the shard gets opened, which benchmarks swap out
+        self.connect = connect
+        self.conn = None
+        self.c = None
+        self.store = None
+        # How many were clocked in when the shard was last closed
+        self.clockedIn = None
+
+    def open(self):
+        # Opens the shard if it isn't already, and marks it as just used
+        if self.conn is None:
+            self.conn = self.connect(self.dbName)
+            self.c = self.conn.cursor()
+            self.store = UserStore(self.c, self.leaderboardSize)
+        self.shards.touch(self)
+        return self
+
+    def reload(self):
+        # Reads the users back in, for when the table was changed underneath the store
+        self.store = UserStore(self.open().c, self.leaderboardSize)
+
+    def close(self):
+        # Commits whatever is pending and lets go of the shard and everything kept from it
+        if self.conn is None:
+            return
+        self.store.flush()
+        self.conn.commit()
+        self.conn.close()
+        self.shards.forget(self)
+        self.clockedIn = len(self.store.clockedIn)
+        self.conn = self.c = self.store = None
+        self.directory.clear()
+
+    def clocked_in(self):
+        # How many people are clocked in, without opening the shard for it
+        store = self.store
+        return len(store.clockedIn) if store is not None else self.clockedIn or 0
+
+class Shards(object):
+    '''
+    Keeps at most size workspaces' shards open. Opening another one
+    closes whichever was used longest ago. '''
+
+    def __init__(self, size):
+        self.size = size
+        self.open = collections.OrderedDict()
+
+    def touch(self, workspace):
+        self.open[workspace] = True
+        self.open.move_to_end(workspace)
+        while len(self.open) > self.size:
+            oldest, _ = self.open.popitem(last=False)
+            oldest.close()
+
+    def forget(self, workspace):
+        self.open.pop(workspace, None)
+
+    def close(self):
+        for workspace in list(self.open):
+            workspace.close()
+
+def load_workspaces(fileName, dbName):
+    '''
+    The workspaces listed in fileName, each a dict with its name and
+    whatever else it sets out of token, tokenVariable (the environment
+    variable holding the token), database, schedule, leaders and botId.
+    A workspace's database is name.db unless it says otherwise. If the
+    file isn't there it's just the one team from the environment, with
+    its data in dbName, the way the bot always ran. '''
+
+    if not os.path.isfile(fileName):
+        return [{'name': 'default', 'database': dbName}]
+    with open(fileName) as f:
+        workspaces = json.load(f)
+    for workspace in workspaces:
+        workspace.setdefault('database', workspace['name'] + '.db')
+    for key in ('name', 'database'):
+        values = [workspace[key] for workspace in workspaces]
+        if len(set(values)) != len(values):
+            raise ValueError("every workspace in " + fileName + " needs its own " + key)
+    return workspaces